@@ -1,2 +1,8 @@
 from .lstm_class import MidiLSTM
-from .ai_generation import AIGenerator
\ No newline at end of file
+from .ai_generation import AIGenerator
+from .ngram_index import NGramIndex
+from .model_registry import ModelRegistry
+from .sampling import candidate_distribution, sample_candidate
+from .ngram_draft import NGramDraft
+from .remi_grammar import RemiGrammar
+from .step_runtime import StepRuntime
\ No newline at end of file
@@ -1,74 +1,280 @@
-from .lstm_class import MidiLSTM
-from AI_TRAINING import MidiTokenizer
+from .ngram_index import NGramIndex
+from .model_registry import model_registry, PRECISIONS
+from .sampling import candidate_distribution, sample_candidate, SAMPLING_METHODS
+from .ngram_draft import NGramDraft
 import torch
 from tqdm import tqdm
-import torch
-import torch.nn.functional as F
+import time
+import asyncio
 
 class AIGenerator:
-    def __init__(self, token_ids, tokens_to_gen = 100, use_first_n_tokens = 10, type_gen = "melody", top_k = 10, temperature = 1.0,): # use_first_n_tokens  is the number of tokens to use as the original sequence for generation
+    def __init__(self, token_ids, tokens_to_gen = 100, use_first_n_tokens = 10, type_gen = "melody", top_k = 10, temperature = 1.0, generation_mode = "stateful", checkpoint_path = None, registry = model_registry, precision = "fp32", sampling = "top_k", top_p = 0.9, min_p = 0.05, seed = None, draft = None, draft_length = 4, grammar_mask = False): # use_first_n_tokens  is the number of tokens to use as the original sequence for generation
         self.token_ids = token_ids[:use_first_n_tokens] if len(token_ids) >= use_first_n_tokens else token_ids
         self.use_first_n_tokens = use_first_n_tokens
-        self.vocab_size = MidiTokenizer().tokenizer.vocab_size
-        self.model = MidiLSTM(vocab_size=self.vocab_size)
-        if type_gen == "melody":
-            self.model.load_state_dict(torch.load(r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\AI_MODELS\best_models\melody_prediction_monophonic.pt"))
-            self.monophonic = True # Means that only one note can be played at a time
-        else:
-            self.model.load_state_dict(torch.load(r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\AI_MODELS\best_models\accompaniment_prediction.pt"))
-            self.monophonic = False # Means that more than one note can be played at a time
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(self.device)
-        self.model.eval()
+        vocab_info = registry.vocab_info()
+        self.vocab_size = vocab_info["vocab_size"]
+        self.eos_id = vocab_info["eos_id"] # Used to stop a sequence early in generate_batch
+        self.monophonic = type_gen == "melody" # Melodies only play one note at a time, accompaniment can play more than one
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision: {precision}, expected one of {list(PRECISIONS)}")
+        self.precision = precision # "fp32", "bf16" or "int8" (dynamically quantized LSTM and fc weights, CPU only)
+        self.device = torch.device("cpu") if precision == "int8" else torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = registry.get(type_gen, checkpoint_path=checkpoint_path, device=self.device, dtype=PRECISIONS[precision]) # Shared, already in eval mode, loaded from disk only the first time
 
         self.tokens_to_generate = tokens_to_gen
 
         # For randomness in generated music
         self.temperature = temperature # Controls the randomness of the predictions, the higher the value, the more random
         self.top_k = top_k # Keep only the top_k predictions to introduce randomness
+        if sampling not in SAMPLING_METHODS:
+            raise ValueError(f"Unknown sampling method: {sampling}, expected one of {SAMPLING_METHODS}")
+        self.sampling = sampling # "top_k", "top_p" (nucleus) or "min_p", the last two filter further within the top_k candidates
+        self.top_p = top_p
+        self.min_p = min_p
+        self.rng = torch.Generator(device=self.device) # Each generator has its own random state so that seeded runs are reproducible
+        if seed is None:
+            self.rng.seed()
+        else:
+            self.rng.manual_seed(seed)
+
+        # "stateful" primes the LSTM on the seed once and then feeds one token at a time, carrying (h, c) over between steps
+        # "window" re-runs the model over the last SEQUENCE_LENGTH tokens for every prediction (the original behaviour, kept for comparison)
+        # "speculative" is stateful, but an n-gram draft guesses several tokens ahead which the model then checks in one pass
+        if generation_mode not in ("stateful", "window", "speculative"):
+            raise ValueError(f"Unknown generation_mode: {generation_mode}")
+        if generation_mode == "speculative" and draft is None:
+            raise ValueError("Speculative generation needs a draft (an NGramDraft or the path of a saved one)")
+        self.generation_mode = generation_mode
+        self.draft = NGramDraft.load(draft) if isinstance(draft, str) else draft
+        self.draft_length = draft_length # Maximum number of tokens the draft proposes per model pass
+        self.speculative_stats = {"proposed": 0, "accepted": 0, "model_passes": 0}
+
+        # The grammar masks out tokens that are invalid in their position (e.g. a Duration straight after a Bar) before sampling
+        self.registry = registry
+        self.grammar = registry.remi_grammar()
+        self.grammar_mask = grammar_mask
+        self.invalid_tokens = None # Number of tokens in the sequence miditok discards when decoding, filled in after generation
+        self.tokens_per_second = None # Filled in after generate() has run
 
         # Constants
         self.SEQUENCE_LENGTH = 64 # The length of sequences this ai was trained on
         self.NGRAM_SIZE = 4 # Size of n-grams to avoid repetition
         self.NGRAM_PENALTY = 1e9 # Penalty to penalize repeated n-grams
 
-    def _get_recent_ngrams(self):
-        ngrams = {} # Dictionary mapping each n-gram (tuple of tokens) to its frequency count
-        for i in range(len(self.token_ids) - self.NGRAM_SIZE + 1): # Extract all possible n-grams from the current sequence
-            g = tuple(self.token_ids[i:i+self.NGRAM_SIZE]) # Form the n-gram with the length of NGRAM_SIZE as an immutable tuple (good for dictionary key)
-            ngrams[g] = ngrams.get(g, 0) + 1 # Increment the count of this n-gram if it has already been seen, or initialize it to 1
-        return ngrams
-
     def get_monophonic(self):
         return self.monophonic
     
+    def _prime(self):
+        """Run the seed sequence through the model once and return the logits for the next token along with the LSTM state"""
+        seed = torch.tensor(self.token_ids, dtype=torch.long).unsqueeze(0).to(self.device)
+        logits, state = self.model(seed, return_last=True, return_state=True)
+        return logits[0].float(), state # Sampling is always done in fp32, whatever precision the model runs in
+
+    def _window_logits(self):
+        """Re-run the model over the last SEQUENCE_LENGTH tokens and return the logits for the next token"""
+        logits = self.model(torch.tensor(self.token_ids[-self.SEQUENCE_LENGTH:], dtype=torch.long).unsqueeze(0).to(self.device))
+        return logits[0, -1].float()  # Get the logits for the last time step
+
+    def _sample_next(self, logits, ngram_index = None, temperature = None, top_k = None, previous_token = None):
+        """Pick the next token id from the logits of the last time step, the optional arguments override the generator's own settings (used for batched rows)"""
+        ngram_index = self.ngram_index if ngram_index is None else ngram_index
+        temperature = self.temperature if temperature is None else temperature
+        top_k = self.top_k if top_k is None else top_k
+        previous_token = self.token_ids[-1] if previous_token is None else previous_token
+
+        candidate_ids, probs = self._next_distribution(logits, ngram_index, temperature, top_k, previous_token)
+        return sample_candidate(candidate_ids, probs, self.rng) # Stochastic sampling to predict one token from the probability distribution of the candidates
+
+    def _next_distribution(self, logits, ngram_index, temperature, top_k, previous_token):
+        """The distribution the next token is sampled from, as candidate ids and their probabilities"""
+        # Apply the grammar mask, which only depends on the type of the previous token
+        if self.grammar_mask:
+            self.grammar.apply_mask(logits, previous_token)
+
+        # Apply n-gram penalty
+        ngram_index.apply_penalty(logits, self.NGRAM_PENALTY) # Reduce the probability of tokens that would repeat an n-gram already in the sequence
+
+        # Temperature, softmax and the top_p/min_p filters are applied to the top_k candidates only rather than the whole vocabulary
+        return candidate_distribution(logits, top_k, temperature, self.sampling, self.top_p, self.min_p)
+
+    def _commit(self, token):
+        """Add a sampled token to the sequence"""
+        self.token_ids.append(token) # Add the predicted token_id to the sequence
+        self.ngram_index.append(token)
+
+    def _single_steps(self):
+        """Predict one token per model call ("stateful" and "window" modes)"""
+        if self.generation_mode == "stateful":
+            logits, state = self._prime() # Only the seed is run through the whole LSTM, every later step reuses (h, c)
+        for i in range(self.tokens_to_generate):
+            if self.generation_mode == "window":
+                logits = self._window_logits()
+
+            next_token = self._sample_next(logits)
+            self._commit(next_token)
+            yield next_token
+
+            if self.generation_mode == "stateful" and i < self.tokens_to_generate - 1: # No need to run the model after the last token
+                logits, state = self.model.step(torch.tensor([next_token], dtype=torch.long, device=self.device), state)
+                logits = logits[0].float()
+
+    def _speculative_steps(self):
+        """
+        Speculative generation: the n-gram draft proposes up to draft_length tokens, the model scores all of them in one pass
+        and each proposal is accepted with the probability the model itself gives it. On the first rejection a replacement is
+        sampled from the model's distribution with the rejected token removed, so the output follows exactly the same
+        distribution as ordinary sampling, it just needs fewer model passes when the draft guesses well.
+        """
+        logits, state = self._prime()
+        generated = 0
+        while generated < self.tokens_to_generate:
+            proposal = self.draft.propose(self.token_ids, min(self.draft_length, self.tokens_to_generate - generated))
+            if not proposal: # The draft has no guess, fall back to a normal step
+                next_token = self._sample_next(logits)
+                self._commit(next_token)
+                generated += 1
+                yield next_token
+                if generated < self.tokens_to_generate:
+                    logits, state = self.model.step(torch.tensor([next_token], dtype=torch.long, device=self.device), state)
+                    logits = logits[0].float()
+                    self.speculative_stats["model_passes"] += 1
+                continue
+
+            # Score every proposed token in one batched pass, starting from the state after the committed tokens
+            proposal_logits, proposal_state = self.model(torch.tensor([proposal], dtype=torch.long, device=self.device), state=state, return_state=True)
+            proposal_logits = proposal_logits[0].float() # Row i is the distribution after proposal[i]
+            self.speculative_stats["model_passes"] += 1
+            self.speculative_stats["proposed"] += len(proposal)
+
+            step_logits = logits
+            replacement = None
+            for i, proposed_token in enumerate(proposal):
+                candidate_ids, probs = self._next_distribution(step_logits, self.ngram_index, self.temperature, self.top_k, self.token_ids[-1])
+                proposed_prob = probs[candidate_ids == proposed_token].sum().item() # 0 if the token isn't one of the candidates
+                if torch.rand(1, generator=self.rng, device=self.device).item() < proposed_prob:
+                    self._commit(proposed_token)
+                    self.speculative_stats["accepted"] += 1
+                    generated += 1
+                    yield proposed_token
+                    step_logits = proposal_logits[i]
+                    continue
+
+                # Rejected: sample from the remaining probability mass instead
+                probs = torch.where(candidate_ids == proposed_token, torch.zeros_like(probs), probs)
+                replacement = sample_candidate(candidate_ids, probs / probs.sum(), self.rng)
+                self._commit(replacement)
+                generated += 1
+                yield replacement
+                accepted = proposal[:i]
+                break
+
+            if replacement is None: # Every proposal was accepted, the state after the last one is already known
+                logits, state = step_logits, proposal_state
+            elif generated < self.tokens_to_generate:
+                # Catch the state up on the accepted proposals plus the replacement token in one pass
+                catch_up = torch.tensor([accepted + [replacement]], dtype=torch.long, device=self.device)
+                logits, state = self.model(catch_up, return_last=True, state=state, return_state=True)
+                logits = logits[0].float()
+                self.speculative_stats["model_passes"] += 1
+
+    @torch.no_grad() # Applied around every resume of the generator, so it also holds when each step runs on a different thread (astream)
+    def stream(self):
+        """Generate tokens one at a time, yielding each token id as soon as it has been sampled"""
+        start_time = time.perf_counter()
+        self.ngram_index = NGramIndex(self.NGRAM_SIZE, self.token_ids) # Built once, then updated as each token is appended
+        steps = self._speculative_steps() if self.generation_mode == "speculative" else self._single_steps()
+        for next_token in tqdm(steps, total=self.tokens_to_generate, desc="Predicting:", unit="predictions"):
+            yield next_token
+
+        elapsed = time.perf_counter() - start_time
+        self.tokens_per_second = self.tokens_to_generate / elapsed if elapsed > 0 else float("inf")
+        print(f"Generated {self.tokens_to_generate} tokens in {elapsed:.2f}s ({self.tokens_per_second:.1f} tokens/sec, {self.generation_mode} mode)")
+        self.invalid_tokens = self.registry.decode_errors(self.token_ids)
+        print(f"{self.invalid_tokens} tokens will be discarded by miditok when decoding (grammar mask {'on' if self.grammar_mask else 'off'})")
+        if self.generation_mode == "speculative" and self.speculative_stats["proposed"]:
+            acceptance = self.speculative_stats["accepted"] / self.speculative_stats["proposed"]
+            print(f"Draft acceptance rate {acceptance:.1%}, {self.speculative_stats['model_passes']} model passes")
+
+    async def astream(self):
+        """Async version of stream(), each step runs in a worker thread so the event loop isn't blocked while the model runs"""
+        tokens = self.stream()
+        finished = object() # Returned by next() once the generator is exhausted
+        while True:
+            token = await asyncio.to_thread(next, tokens, finished)
+            if token is finished:
+                break
+            yield token
+
     def generate(self):
+        for _ in self.stream(): # Run the stream to the end, the tokens are collected in self.token_ids
+            pass
+
+    def _per_row(self, value, default, num_samples):
+        """Expand a single setting (or None for the generator's default) into one value per batch row"""
+        if value is None:
+            value = default
+        if isinstance(value, (list, tuple)):
+            if len(value) != num_samples:
+                raise ValueError(f"Expected {num_samples} values, got {len(value)}")
+            return list(value)
+        return [value] * num_samples
+
+    def generate_batch(self, num_samples, temperatures = None, top_ks = None, max_tokens = None, stop_at_eos = True):
+        """
+        Generate several variations of the seed together, advancing all of them as one [N, 1] batch per step.
+        temperatures, top_ks, max_tokens: A single value for every row or a list with one value per row (None uses the generator's settings)
+        stop_at_eos: Stop a row early once it samples the EOS token
+        Returns a list of num_samples token id lists (seed + generated tokens)
+        """
+        temperatures = self._per_row(temperatures, self.temperature, num_samples)
+        top_ks = self._per_row(top_ks, self.top_k, num_samples)
+        max_tokens = self._per_row(max_tokens, self.tokens_to_generate, num_samples)
+
+        sequences = [list(self.token_ids) for _ in range(num_samples)]
+        ngram_indexes = [NGramIndex(self.NGRAM_SIZE, sequence) for sequence in sequences] # Each row keeps its own repetition penalty state
+        active_rows = [row for row in range(num_samples) if max_tokens[row] > 0] # Rows that haven't hit EOS or their length limit yet
+
+        start_time = time.perf_counter()
         with torch.no_grad():
-            for i in tqdm(range(self.tokens_to_generate), desc="Predicting:", unit="predictions"):
-                logits = self.model(torch.tensor(self.token_ids[-self.SEQUENCE_LENGTH:], dtype=torch.long).unsqueeze(0).to(self.device))
-                logits = logits[0, -1]  # Get the logits for the last time step
-                
-                # Apply n-gram penalty
-                if len(self.token_ids) >= self.NGRAM_SIZE:
-                    recent_ngrams = self._get_recent_ngrams() # Get the recent n-grams from the current sequence
-                    for token_id in range(len(logits)):
-                        ngram = tuple(self.token_ids[-(self.NGRAM_SIZE-1):] + [token_id]) # Form the n-gram with the current token
-                        if ngram in recent_ngrams:
-                            logits[token_id] -= self.NGRAM_PENALTY  # Reduce the probability of repeated n-grams
-
-                # Apply temperature
-                logits = logits / self.temperature # This will change the logits by scaling them according to the temperature to introduce randomness
-
-                # Apply top-k filtering
-                top_k_values, topk_indices = torch.topk(logits, self.top_k) # Will return the top_k number of values that are most likely
-                filtered_logits = torch.full_like(logits, float('-inf')) # Will create a new tensor with the same shape as logits, filled with -inf
-                filtered_logits[topk_indices] = logits[topk_indices] # Will only replace the top_k logits (in this new tensor) with their original values so that other values cant be picked
-
-                # Convert to probabilities and sample them
-                probs = F.softmax(filtered_logits, dim=-1) # Convert logits to probabilities by applying softmax (will make sure that 0 < probability < 1 and that they sum to 1)
-                next_token = torch.multinomial(probs, 1).item() # Stochastic sampling to predict one token from the probability distribution of the top_k tokens
-                
-                self.token_ids.append(next_token) # Add the predicted token_id to the sequence
+            # The seed is the same for every row, so prime once and copy the state across the batch
+            logits, state = self._prime()
+            logits = logits.unsqueeze(0).repeat(len(active_rows), 1) # [N, vocab]
+            state = tuple(s.repeat(1, len(active_rows), 1) for s in state) # (h, c): [num_layers, N, hidden]
+
+            progress = tqdm(total=sum(max_tokens[row] for row in active_rows), desc="Predicting batch:", unit="predictions")
+            while active_rows:
+                next_tokens = []
+                still_active = [] # Positions (within the current batch) of rows that continue after this step
+                for position, row in enumerate(active_rows):
+                    next_token = self._sample_next(logits[position], ngram_indexes[row], temperatures[row], top_ks[row], sequences[row][-1])
+                    sequences[row].append(next_token)
+                    ngram_indexes[row].append(next_token)
+                    next_tokens.append(next_token)
+                    progress.update(1)
+
+                    generated = len(sequences[row]) - len(self.token_ids)
+                    if generated < max_tokens[row] and not (stop_at_eos and next_token == self.eos_id):
+                        still_active.append(position)
+
+                if not still_active:
+                    break
+                if len(still_active) < len(active_rows): # Drop finished rows from the batch so they aren't computed any more
+                    keep = torch.tensor(still_active, dtype=torch.long, device=self.device)
+                    state = tuple(s.index_select(1, keep) for s in state)
+                    next_tokens = [next_tokens[position] for position in still_active]
+                    active_rows = [active_rows[position] for position in still_active]
+
+                logits, state = self.model.step(torch.tensor(next_tokens, dtype=torch.long, device=self.device), state)
+                logits = logits.float()
+            progress.close()
+
+        elapsed = time.perf_counter() - start_time
+        total_generated = sum(len(sequence) - len(self.token_ids) for sequence in sequences)
+        self.tokens_per_second = total_generated / elapsed if elapsed > 0 else float("inf")
+        print(f"Generated {total_generated} tokens over {num_samples} samples in {elapsed:.2f}s ({self.tokens_per_second:.1f} tokens/sec)")
+        self.invalid_tokens = sum(self.registry.decode_errors(sequence) for sequence in sequences)
+        print(f"{self.invalid_tokens} tokens will be discarded by miditok when decoding (grammar mask {'on' if self.grammar_mask else 'off'})")
+        return sequences
 
     def get_generated_token_ids(self):
         return self.token_ids
\ No newline at end of file
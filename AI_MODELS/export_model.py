@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from .model_registry import model_registry, ModelRegistry
+from .step_runtime import StepRuntime
+
+class MidiLSTMStep(nn.Module):
+    """Single-step wrapper around MidiLSTM with explicit state tensors: (token [B, 1], h, c) → (logits [B, vocab], h, c)"""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, token, h, c):
+        logits, (h, c) = self.model(token, return_last=True, state=(h, c), return_state=True)
+        return logits, h, c
+
+def _example_inputs(model, batch_size = 1):
+    token = torch.zeros((batch_size, 1), dtype=torch.long)
+    state_shape = (model.lstm.num_layers, batch_size, model.lstm.hidden_size)
+    return token, torch.zeros(state_shape), torch.zeros(state_shape)
+
+def _write_config(export_path, model):
+    """Settings the StepRuntime needs, saved next to the export so the runtime doesn't have to import the tokenizer"""
+    vocab_info = model_registry.vocab_info()
+    config = {
+        "vocab_size": vocab_info["vocab_size"],
+        "eos_id": vocab_info["eos_id"],
+        "num_layers": model.lstm.num_layers,
+        "hidden_size": model.lstm.hidden_size,
+    }
+    with open(f"{export_path}.json", "w") as f:
+        json.dump(config, f, indent=2)
+
+def export_model(type_gen = "melody", output_dir = "exported_models", checkpoint_path = None, formats = ("torchscript", "onnx")):
+    """Export the (fp32, CPU) model for a generation type in single-step form, returning the paths written"""
+    model = model_registry.get(type_gen, checkpoint_path=checkpoint_path, device="cpu")
+    step_model = MidiLSTMStep(model).eval()
+    example = _example_inputs(model)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+
+    if "torchscript" in formats:
+        path = os.path.join(output_dir, f"{type_gen}_step.pt")
+        with torch.no_grad():
+            traced = torch.jit.trace(step_model, example)
+        traced.save(path)
+        _write_config(path, model)
+        paths["torchscript"] = path
+
+    if "onnx" in formats:
+        path = os.path.join(output_dir, f"{type_gen}_step.onnx")
+        torch.onnx.export(
+            step_model, example, path,
+            input_names=["token", "h", "c"],
+            output_names=["logits", "h_out", "c_out"],
+            dynamic_axes={"token": {0: "batch"}, "h": {1: "batch"}, "c": {1: "batch"}, "logits": {0: "batch"}, "h_out": {1: "batch"}, "c_out": {1: "batch"}},
+            opset_version=17,
+        )
+        _write_config(path, model)
+        paths["onnx"] = path
+
+    for export_format, path in paths.items():
+        print(f"Exported {export_format} model to {path}")
+    return paths
+
+def check_parity(type_gen, export_paths, steps = 64, seed = 0, atol = 1e-4, checkpoint_path = None):
+    """Feed the same random tokens through the eager model and each export step by step and report the largest logit difference"""
+    model = model_registry.get(type_gen, checkpoint_path=checkpoint_path, device="cpu")
+    tokens = np.random.default_rng(seed).integers(0, model.fc.out_features, size=steps)
+
+    eager_logits = []
+    with torch.no_grad():
+        state = None
+        for token_id in tokens:
+            logits, state = model.step(torch.tensor([int(token_id)]), state)
+            eager_logits.append(logits.numpy())
+
+    results = {}
+    for export_format, path in export_paths.items():
+        runtime = StepRuntime(path)
+        h, c = runtime.initial_state()
+        max_difference = 0.0
+        for token_id, expected in zip(tokens, eager_logits):
+            logits, h, c = runtime.step([int(token_id)], h, c)
+            max_difference = max(max_difference, float(np.abs(logits - expected).max()))
+        results[export_format] = {"max_abs_difference": max_difference, "passed": max_difference <= atol}
+        print(f"{export_format:>12}: max |logit difference| {max_difference:.2e} ({'ok' if max_difference <= atol else 'MISMATCH'})")
+    return results
+
+def compare_runtimes(type_gen, export_paths, seed_token_ids, tokens_to_gen = 500, checkpoint_path = None):
+    """Startup time and generation throughput of the eager model against each exported runtime"""
+    results = {}
+
+    start_time = time.perf_counter()
+    model = ModelRegistry().get(type_gen, checkpoint_path=checkpoint_path, device="cpu") # A fresh registry so the load is cold, including the tokenizer vocab lookup
+    startup_seconds = time.perf_counter() - start_time
+    with torch.no_grad():
+        logits, state = model(torch.tensor([list(seed_token_ids)]), return_last=True, return_state=True)
+        start_time = time.perf_counter()
+        for _ in range(tokens_to_gen):
+            next_token = torch.multinomial(torch.softmax(logits[0], dim=-1), 1)
+            logits, state = model.step(next_token, state)
+        results["eager"] = {"startup_seconds": startup_seconds, "tokens_per_second": tokens_to_gen / (time.perf_counter() - start_time)}
+
+    for export_format, path in export_paths.items():
+        runtime = StepRuntime(path)
+        runtime.generate(seed_token_ids, tokens_to_gen=tokens_to_gen)
+        results[export_format] = {"startup_seconds": runtime.startup_seconds, "tokens_per_second": runtime.tokens_per_second}
+
+    for name, result in results.items():
+        print(f"{name:>12}: startup {result['startup_seconds'] * 1000:.0f} ms, {result['tokens_per_second']:.1f} tokens/sec")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export MidiLSTM as a single-step TorchScript/ONNX model")
+    parser.add_argument("--type", default="melody", help='Generation type, "melody" or "acc"')
+    parser.add_argument("--checkpoint", default=None, help="Checkpoint to export (defaults to the one AIGenerator uses)")
+    parser.add_argument("--output-dir", default="exported_models")
+    parser.add_argument("--formats", nargs="+", default=["torchscript", "onnx"], choices=["torchscript", "onnx"])
+    parser.add_argument("--check", action="store_true", help="Check the exports against the eager model afterwards")
+    args = parser.parse_args()
+
+    exported = export_model(args.type, args.output_dir, args.checkpoint, args.formats)
+    if args.check:
+        check_parity(args.type, exported, checkpoint_path=args.checkpoint)
@@ -0,0 +1,130 @@
+import torch
+import torch.nn.functional as F
+import time
+from .ai_generation import AIGenerator
+from .sampling import candidate_distribution, sample_candidate
+
+def benchmark_generation_modes(token_ids, tokens_to_gen = 500, type_gen = "melody", seed = 0, modes = ("window", "stateful"), draft = None):
+    """Generate the same number of tokens from the same seed in each generation mode and report tokens/sec for each (add "speculative" to modes along with a draft)"""
+    results = {}
+    for mode in modes:
+        # Same random state for every mode so that the outputs can be compared
+        generator = AIGenerator(token_ids=list(token_ids), tokens_to_gen=tokens_to_gen, type_gen=type_gen, generation_mode=mode, seed=seed, draft=draft)
+        generator.generate()
+        results[mode] = {"tokens_per_second": generator.tokens_per_second, "token_ids": generator.get_generated_token_ids()}
+
+    for mode, result in results.items():
+        print(f"{mode:>10}: {result['tokens_per_second']:.1f} tokens/sec")
+    if "window" in results and "stateful" in results:
+        speedup = results["stateful"]["tokens_per_second"] / results["window"]["tokens_per_second"]
+        # The stateful mode remembers the whole sequence rather than only the last SEQUENCE_LENGTH tokens, so the outputs can drift apart
+        matching = sum(a == b for a, b in zip(results["window"]["token_ids"], results["stateful"]["token_ids"]))
+        print(f"Stateful speedup: {speedup:.1f}x, {matching}/{len(results['window']['token_ids'])} tokens identical")
+    return results
+
+def benchmark_precisions(token_ids, tokens_to_gen = 500, type_gen = "melody", seed = 0, precisions = ("fp32", "bf16", "int8")):
+    """Report generation speed for each inference precision, run from the same seed"""
+    results = {}
+    for precision in precisions:
+        generator = AIGenerator(token_ids=list(token_ids), tokens_to_gen=tokens_to_gen, type_gen=type_gen, precision=precision, seed=seed)
+        generator.generate()
+        results[precision] = generator.tokens_per_second
+
+    baseline = results.get("fp32")
+    for precision, tokens_per_second in results.items():
+        speedup = f" ({tokens_per_second / baseline:.2f}x fp32)" if baseline else ""
+        print(f"{precision:>5}: {tokens_per_second:.1f} tokens/sec{speedup}")
+    return results
+
+def precision_agreement(token_ids, tokens_to_gen = 200, type_gen = "melody", seeds = (0, 1, 2), precisions = ("bf16", "int8"), top_k = 10):
+    """
+    Check how closely the reduced precision models follow the fp32 model.
+    For each seed a sequence is generated with fp32, then every model scores that same sequence (teacher forcing) and the next-token distributions are compared.
+    Reports top-1 agreement, overlap of the top_k candidates and mean KL(fp32 || precision) per precision.
+    """
+    reference = AIGenerator(token_ids=list(token_ids), type_gen=type_gen, precision="fp32")
+    generators = {precision: AIGenerator(token_ids=list(token_ids), type_gen=type_gen, precision=precision) for precision in precisions}
+
+    totals = {precision: {"top1": 0.0, "topk_overlap": 0.0, "kl": 0.0, "steps": 0} for precision in precisions}
+    with torch.no_grad():
+        for seed in seeds:
+            generator = AIGenerator(token_ids=list(token_ids), tokens_to_gen=tokens_to_gen, type_gen=type_gen, precision="fp32", seed=seed)
+            generator.generate()
+            sequence = torch.tensor(generator.get_generated_token_ids(), dtype=torch.long).unsqueeze(0)
+
+            reference_log_probs = F.log_softmax(reference.model(sequence.to(reference.device))[0].float().cpu(), dim=-1) # [T, vocab]
+            reference_top_k = reference_log_probs.topk(top_k, dim=-1).indices
+            for precision, other in generators.items():
+                log_probs = F.log_softmax(other.model(sequence.to(other.device))[0].float().cpu(), dim=-1)
+                top_k_ids = log_probs.topk(top_k, dim=-1).indices
+                overlap = (reference_top_k.unsqueeze(-1) == top_k_ids.unsqueeze(-2)).any(-1).float().mean(-1) # Share of the fp32 top_k candidates kept at each step
+
+                totals[precision]["top1"] += (reference_top_k[:, 0] == top_k_ids[:, 0]).float().sum().item()
+                totals[precision]["topk_overlap"] += overlap.sum().item()
+                totals[precision]["kl"] += (reference_log_probs.exp() * (reference_log_probs - log_probs)).sum(-1).sum().item()
+                totals[precision]["steps"] += sequence.size(1)
+
+    results = {}
+    for precision, total in totals.items():
+        steps = max(total["steps"], 1)
+        results[precision] = {"top1_agreement": total["top1"] / steps, "top_k_overlap": total["topk_overlap"] / steps, "mean_kl": total["kl"] / steps}
+        print(f"{precision:>5}: top-1 agreement {results[precision]['top1_agreement']:.3f}, top-{top_k} overlap {results[precision]['top_k_overlap']:.3f}, mean KL {results[precision]['mean_kl']:.5f}")
+    return results
+
+def _full_vocab_sample(logits, top_k, temperature):
+    """The previous sampling step, kept for comparison: full-vocab -inf tensor, scatter, softmax over the whole vocabulary"""
+    logits = logits / temperature
+    top_k_values, topk_indices = torch.topk(logits, top_k)
+    filtered_logits = torch.full_like(logits, float('-inf'))
+    filtered_logits[topk_indices] = logits[topk_indices]
+    probs = F.softmax(filtered_logits, dim=-1)
+    return torch.multinomial(probs, 1).item()
+
+def benchmark_sampling(vocab_size = 264, top_k = 10, temperature = 1.0, steps = 10000, device = "cpu", seed = 0):
+    """Microbenchmark of the per-step sampling cost before (full vocabulary) and after (top_k candidates only) for each sampling method"""
+    logits = torch.randn(steps, vocab_size, device=device)
+    results = {}
+
+    start_time = time.perf_counter()
+    for step in range(steps):
+        _full_vocab_sample(logits[step], top_k, temperature)
+    results["full_vocab"] = (time.perf_counter() - start_time) / steps
+
+    for method in ("top_k", "top_p", "min_p"):
+        rng = torch.Generator(device=device).manual_seed(seed)
+        start_time = time.perf_counter()
+        for step in range(steps):
+            candidate_ids, probs = candidate_distribution(logits[step], top_k, temperature, method)
+            sample_candidate(candidate_ids, probs, rng)
+        results[method] = (time.perf_counter() - start_time) / steps
+
+    # Two generators with the same seed have to produce the same tokens
+    samples = []
+    for _ in range(2):
+        rng = torch.Generator(device=device).manual_seed(seed)
+        samples.append([sample_candidate(*candidate_distribution(logits[step], top_k, temperature), rng) for step in range(min(steps, 200))])
+    results["reproducible"] = samples[0] == samples[1]
+
+    for name, seconds in results.items():
+        if name != "reproducible":
+            print(f"{name:>10}: {seconds * 1e6:.1f} us/step")
+    print(f"Seeded sampling reproducible: {results['reproducible']}")
+    return results
+
+def benchmark_grammar_mask(token_ids, tokens_to_gen = 500, type_gen = "melody", seeds = (0, 1, 2)):
+    """Count the tokens miditok would discard at decode time (miditok's own count, not the grammar's), with the REMI grammar mask off and on"""
+    results = {}
+    for grammar_mask in (False, True):
+        invalid = 0
+        tokens_per_second = 0.0
+        for seed in seeds:
+            generator = AIGenerator(token_ids=list(token_ids), tokens_to_gen=tokens_to_gen, type_gen=type_gen, seed=seed, grammar_mask=grammar_mask)
+            generator.generate()
+            invalid += generator.invalid_tokens
+            tokens_per_second += generator.tokens_per_second / len(seeds)
+        results["on" if grammar_mask else "off"] = {"invalid_tokens": invalid, "tokens_per_second": tokens_per_second}
+
+    total = tokens_to_gen * len(seeds)
+    for name, result in results.items():
+        print(f"Grammar mask {name:>3}: {result['invalid_tokens']}/{total} tokens discarded, {result['tokens_per_second']:.1f} tokens/sec")
+    return results
@@ -34,11 +34,24 @@ class MidiLSTM(nn.Module):
         nn.init.xavier_uniform_(self.fc.weight) # Start weights at the right scale for smoother training
         nn.init.zeros_(self.fc.bias) # Sets the bias to 0 so that the model learns all bias based on the dataset
 
-    def forward(self, x, return_last=False):
+    def forward(self, x, return_last=False, state=None, return_state=False):
         x = self.embedding(x)            # Converts tokens to vectors: [B, seq_len] → [B, seq_len, embed]
-        out, _ = self.lstm(x)            # out: [B, seq_len, hidden]
-        # _ is the hidden state and cell state, which we ignore here
+        out, new_state = self.lstm(x, state)  # out: [B, seq_len, hidden]
+        # new_state is the (hidden state, cell state) after the last time step, state=None starts from zeros
         logits = self.fc(out)  # predict each next token at every step: [B, seq_len, vocab_size]
         if return_last:
-            return logits[:, -1, :]  # return only last time step's logits: [B, vocab_size]
-        return logits
\ No newline at end of file
+            logits = logits[:, -1, :]  # return only last time step's logits: [B, vocab_size]
+        if return_state:
+            return logits, new_state
+        return logits
+
+    def step(self, token, state=None):
+        """
+        Advance the model by a single time step, carrying the LSTM state over from the previous call.
+        token: [B] or [B, 1] tensor of token ids
+        state: (h, c) returned by the previous call to step/forward, or None to start from zeros
+        Returns the next-token logits [B, vocab_size] and the new (h, c)
+        """
+        if token.dim() == 1:
+            token = token.unsqueeze(1) # [B] → [B, 1]
+        return self.forward(token, return_last=True, state=state, return_state=True)
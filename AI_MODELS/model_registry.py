@@ -0,0 +1,123 @@
+import os
+import threading
+from collections import OrderedDict
+import torch
+import torch.nn as nn
+from .lstm_class import MidiLSTM
+from .remi_grammar import RemiGrammar
+
+MELODY_CHECKPOINT = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\AI_MODELS\best_models\melody_prediction_monophonic.pt"
+ACCOMPANIMENT_CHECKPOINT = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\AI_MODELS\best_models\accompaniment_prediction.pt"
+
+def default_checkpoint(type_gen):
+    """Checkpoint used for a generation type when no path is given"""
+    return MELODY_CHECKPOINT if type_gen == "melody" else ACCOMPANIMENT_CHECKPOINT
+
+# Inference precisions selectable from AIGenerator, qint8 means dynamically quantized int8 weights for the LSTM and fc layers
+PRECISIONS = {
+    "fp32": torch.float32,
+    "bf16": torch.bfloat16,
+    "int8": torch.qint8,
+}
+
+def default_device():
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded MidiLSTM models so that checkpoints are read from disk once and shared between generators and threads.
+    max_models: Maximum number of models kept in memory, the least recently used one is dropped when this is exceeded
+    """
+    def __init__(self, max_models = 4):
+        self.max_models = max_models
+        self._models = OrderedDict() # Maps (type_gen, checkpoint path, device, dtype) to a loaded model, least recently used first
+        self._lock = threading.RLock() # Loading happens under the lock so two threads never load the same checkpoint twice
+        self._tokenizer = None
+        self._vocab_info = None
+        self._grammar = None
+
+    def tokenizer(self):
+        """The miditok tokenizer, built once instead of building a MidiTokenizer per request"""
+        with self._lock:
+            if self._tokenizer is None:
+                from AI_TRAINING import MidiTokenizer # Imported here so that the registry can be used without loading the training stack up front
+                self._tokenizer = MidiTokenizer().tokenizer
+            return self._tokenizer
+
+    def vocab_info(self):
+        """Vocabulary size and special token ids of the tokenizer"""
+        with self._lock:
+            if self._vocab_info is None:
+                tokenizer = self.tokenizer()
+                self._vocab_info = {"vocab_size": tokenizer.vocab_size, "eos_id": tokenizer.vocab["EOS_None"], "vocab": dict(tokenizer.vocab)}
+            return self._vocab_info
+
+    def remi_grammar(self):
+        """REMI token-order grammar built from the tokenizer's vocab, shared like the models"""
+        with self._lock:
+            if self._grammar is None:
+                self._grammar = RemiGrammar(self.vocab_info()["vocab"])
+            return self._grammar
+
+    def decode_errors(self, token_ids):
+        """
+        Number of tokens miditok counts as errors in a sequence (a token type that can't follow the previous one, a duplicated note, a Position going back in time),
+        i.e. the tokens it discards when decoding. Measured by miditok itself, independently of the grammar mask
+        """
+        if len(token_ids) == 0:
+            return 0
+        from miditok import TokSequence
+        return round(self.tokenizer().tokens_errors(TokSequence(ids=list(token_ids))) * len(token_ids)) # tokens_errors is the ratio of errors to tokens
+
+    def _key(self, type_gen, checkpoint_path, device, dtype):
+        checkpoint_path = os.path.abspath(checkpoint_path or default_checkpoint(type_gen))
+        device = torch.device(device) if device is not None else default_device()
+        return (type_gen, checkpoint_path, str(device), str(dtype))
+
+    def _load(self, checkpoint_path, device, dtype):
+        model = MidiLSTM(vocab_size=self.vocab_info()["vocab_size"])
+        model.load_state_dict(torch.load(checkpoint_path, map_location=device))
+        model.eval()
+        if dtype == torch.qint8:
+            if device.type != "cpu":
+                raise ValueError("int8 dynamic quantization is only supported on the CPU")
+            # Weights of the LSTM and fc layers are stored as int8 and activations are quantized on the fly, the embedding stays in fp32
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.LSTM, nn.Linear}, dtype=torch.qint8)
+        else:
+            model.to(device=device, dtype=dtype)
+        for parameter in model.parameters():
+            parameter.requires_grad_(False) # Shared models are only ever used for inference
+        return model
+
+    def get(self, type_gen = "melody", checkpoint_path = None, device = None, dtype = torch.float32):
+        """Return the shared eval-mode model for these settings, loading it on first use"""
+        key = self._key(type_gen, checkpoint_path, device, dtype)
+        with self._lock:
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key) # Mark as most recently used
+                return model
+
+            _, checkpoint_path, device, _ = key
+            model = self._load(checkpoint_path, torch.device(device), dtype)
+            self._models[key] = model
+            while len(self._models) > self.max_models:
+                evicted_key, _ = self._models.popitem(last=False) # Drop the least recently used model
+                print(f"Evicted model {evicted_key} from the registry")
+            return model
+
+    def warm_up(self, type_gens = ("melody", "acc"), device = None, dtype = torch.float32):
+        """Load the models for the given generation types ahead of the first request"""
+        for type_gen in type_gens:
+            self.get(type_gen, device=device, dtype=dtype)
+
+    def is_loaded(self, type_gen = "melody", checkpoint_path = None, device = None, dtype = torch.float32):
+        with self._lock:
+            return self._key(type_gen, checkpoint_path, device, dtype) in self._models
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+# Shared by every AIGenerator in the process
+model_registry = ModelRegistry()
@@ -0,0 +1,116 @@
+import os
+from glob import glob
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from tqdm import tqdm
+
+TOKEN_BITS = 16 # Token ids are stored as int16 by tokenize_dataset.py, so up to 4 of them pack into one int64 key
+
+class NGramDraft:
+    """
+    Cheap draft model for speculative generation: the most common next token after each n-gram of the training corpus.
+    tables: Maps each n-gram order to a dict from packed (n-1)-token prefix key to the most frequent next token
+    """
+    def __init__(self, tables):
+        self.tables = tables
+        self.max_order = max(tables) if tables else 1
+
+    @staticmethod
+    def _pack(tokens):
+        """Pack a sequence of token ids into a single integer key"""
+        key = 0
+        for token in tokens:
+            key = (key << TOKEN_BITS) | int(token)
+        return key
+
+    @classmethod
+    def from_npy_dir(cls, npy_dir, max_order = 4, min_count = 2, max_files = None):
+        """Count the n-grams (orders 2 to max_order) of every .npy token file written by tokenize_dataset.py in its "npy" save format"""
+        from AI_TRAINING.packed_corpus import INFO_FILE
+        if os.path.exists(os.path.join(npy_dir, INFO_FILE)): # Its .npy files are the corpus index, not songs
+            raise ValueError(f"{npy_dir} is a packed corpus, build the draft with NGramDraft.from_packed_corpus")
+        paths = sorted(glob(os.path.join(npy_dir, "**", "*.npy"), recursive=True))[:max_files]
+        return cls._from_songs((np.load(path) for path in paths), len(paths), max_order, min_count, npy_dir)
+
+    @classmethod
+    def from_packed_corpus(cls, corpus_dir, max_order = 4, min_count = 2, max_files = None):
+        """Count the n-grams (orders 2 to max_order) of every song of a packed corpus, tokenize_dataset.py's default output"""
+        from AI_TRAINING.packed_corpus import PackedCorpus # Imported here so that generation doesn't need the training code
+        corpus = PackedCorpus(corpus_dir)
+        num_songs = min(len(corpus), max_files) if max_files is not None else len(corpus)
+        return cls._from_songs((corpus.song(song_id) for song_id in range(num_songs)), num_songs, max_order, min_count, corpus_dir)
+
+    @classmethod
+    def _from_songs(cls, songs, num_songs, max_order, min_count, source):
+        """Build the tables from an iterable of token arrays, raising if they come out empty (a draft that never proposes anything would silently slow generation down)"""
+        keys_by_order = {order: [] for order in range(2, max_order + 1)}
+        counts_by_order = {order: [] for order in range(2, max_order + 1)}
+        for tokens in tqdm(songs, total=num_songs, desc="Counting n-grams", unit="file"):
+            tokens = np.asarray(tokens, dtype=np.int64)
+            for order in keys_by_order:
+                if len(tokens) < order:
+                    continue
+                windows = sliding_window_view(tokens, order) # [num_ngrams, order] view, no copy
+                keys = np.zeros(len(windows), dtype=np.int64)
+                for column in range(order):
+                    keys = (keys << TOKEN_BITS) | windows[:, column]
+                keys, counts = np.unique(keys, return_counts=True) # Reduce per file so the lists stay small
+                keys_by_order[order].append(keys)
+                counts_by_order[order].append(counts)
+
+        tables = {}
+        for order in keys_by_order:
+            if not keys_by_order[order]:
+                continue
+            keys, inverse = np.unique(np.concatenate(keys_by_order[order]), return_inverse=True)
+            counts = np.bincount(inverse, weights=np.concatenate(counts_by_order[order]))
+            keep = counts >= min_count # Rare n-grams make poor guesses
+            keys, counts = keys[keep], counts[keep]
+
+            prefixes = keys >> TOKEN_BITS
+            next_tokens = keys & ((1 << TOKEN_BITS) - 1)
+            ordering = np.lexsort((-counts, prefixes)) # By prefix, most frequent continuation first
+            prefixes, next_tokens = prefixes[ordering], next_tokens[ordering]
+            first = np.ones(len(prefixes), dtype=bool)
+            first[1:] = prefixes[1:] != prefixes[:-1]
+            tables[order] = dict(zip(prefixes[first].tolist(), next_tokens[first].tolist()))
+        if not any(tables.values()):
+            raise ValueError(f"No n-gram was seen {min_count} times in {num_songs} songs from {source}: "
+                             "is it empty, or in the other format (from_npy_dir for .npy files, from_packed_corpus for a packed corpus)?")
+        return cls(tables)
+
+    def save(self, path):
+        arrays = {}
+        for order, table in self.tables.items():
+            arrays[f"prefix_{order}"] = np.fromiter(table.keys(), dtype=np.int64, count=len(table))
+            arrays[f"next_{order}"] = np.fromiter(table.values(), dtype=np.int64, count=len(table))
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        orders = sorted(int(name.split("_")[1]) for name in data.files if name.startswith("prefix_"))
+        if not any(len(data[f"prefix_{order}"]) for order in orders):
+            raise ValueError(f"The draft saved in {path} is empty")
+        return cls({order: dict(zip(data[f"prefix_{order}"].tolist(), data[f"next_{order}"].tolist())) for order in orders})
+
+    def _lookup(self, context):
+        """Most likely next token after the context, backing off to shorter n-grams when the longest one hasn't been seen"""
+        for order in range(self.max_order, 1, -1):
+            if order in self.tables and len(context) >= order - 1:
+                next_token = self.tables[order].get(self._pack(context[-(order - 1):]))
+                if next_token is not None:
+                    return next_token
+        return None
+
+    def propose(self, token_ids, num_tokens):
+        """Guess up to num_tokens continuation tokens, stopping early when the draft has no guess"""
+        context = list(token_ids[-(self.max_order - 1):])
+        proposal = []
+        for _ in range(num_tokens):
+            next_token = self._lookup(context)
+            if next_token is None:
+                break
+            proposal.append(next_token)
+            context.append(next_token)
+        return proposal
@@ -0,0 +1,37 @@
+from collections import deque
+import torch
+
+class NGramIndex:
+    """
+    Incrementally maintained index of every n-gram in a token sequence, used to stop the generator repeating itself.
+    ngram_size: Size of the n-grams to track
+    token_ids: Tokens already in the sequence (e.g. the seed), added in order
+    """
+    def __init__(self, ngram_size, token_ids = ()):
+        self.ngram_size = ngram_size
+        self.next_tokens = {} # Maps each (n-1)-gram prefix to the set of tokens that have already followed it
+        self.recent = deque(maxlen=ngram_size - 1) # Only the last n-1 tokens are needed to form the next prefix
+        self.length = 0
+        for token_id in token_ids:
+            self.append(token_id)
+
+    def append(self, token_id):
+        """Add a token to the end of the sequence, O(1) per token"""
+        if self.length >= self.ngram_size - 1: # The last n-1 tokens plus this one form a complete n-gram
+            self.next_tokens.setdefault(tuple(self.recent), set()).add(token_id)
+        self.recent.append(token_id)
+        self.length += 1
+
+    def banned_next_tokens(self):
+        """Tokens that would complete an n-gram which is already in the sequence"""
+        if self.length < self.ngram_size - 1:
+            return ()
+        return self.next_tokens.get(tuple(self.recent), ())
+
+    def apply_penalty(self, logits, penalty):
+        """Subtract the penalty from the logits of every banned next token in one masked tensor operation (in place)"""
+        banned = self.banned_next_tokens()
+        if banned:
+            banned_ids = torch.tensor(list(banned), dtype=torch.long, device=logits.device)
+            logits[banned_ids] -= penalty
+        return logits
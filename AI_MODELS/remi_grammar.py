@@ -0,0 +1,68 @@
+import torch
+
+# Which token types may follow each token type in a REMI sequence (as configured in MidiTokenizer)
+# "Start" is the state before any token has been generated: miditok opens a sequence with a Bar, or with a Rest/Position when the first note comes later
+REMI_TRANSITIONS = {
+    "Start": ["Bar", "Position", "Rest"],
+    "BOS": ["Bar", "Position", "Rest"],
+    "Bar": ["Bar", "Position", "Rest", "EOS"],
+    "Position": ["Pitch", "Chord"],
+    "Chord": ["Pitch"],
+    "Pitch": ["Velocity"],
+    "Velocity": ["Duration"],
+    "Duration": ["Pitch", "Position", "Bar", "Rest", "EOS"],
+    "Rest": ["Rest", "Position", "Bar", "EOS"],
+    "EOS": ["Bar"],
+    "PAD": ["Bar"],
+    "MASK": ["Bar"],
+}
+
+class RemiGrammar:
+    """
+    Small finite-state machine over REMI token types, used to stop the generator sampling tokens that are invalid in their position
+    (e.g. a Duration with no Pitch), which miditok would otherwise drop when decoding.
+    The state is simply the type of the last token, so advancing it is one list lookup per token.
+    vocab: The tokenizer's vocabulary, mapping token strings (e.g. "Pitch_60") to ids
+    """
+    def __init__(self, vocab, transitions = REMI_TRANSITIONS):
+        self.types = list(transitions) # Index of each token type = its state number
+        type_index = {token_type: index for index, token_type in enumerate(self.types)}
+        self.start_state = type_index["Start"]
+
+        vocab_size = max(vocab.values()) + 1
+        self.token_state = [self.start_state] * vocab_size # State reached after each token id
+        for token, token_id in vocab.items():
+            self.token_state[token_id] = type_index.get(token.split("_")[0], self.start_state)
+        present_types = {self.types[state] for state in self.token_state}
+
+        # Types missing from the vocab (e.g. no velocities) are skipped over, so Pitch → Velocity → Duration becomes Pitch → Duration
+        def allowed_types(token_type, seen = ()):
+            allowed = set()
+            for next_type in transitions[token_type]:
+                if next_type in present_types:
+                    allowed.add(next_type)
+                elif next_type in transitions and next_type not in seen:
+                    allowed |= allowed_types(next_type, seen + (next_type,))
+            return allowed
+
+        # Additive mask per state: 0 for allowed next tokens, -inf for the rest
+        token_types = torch.tensor(self.token_state)
+        self.masks = torch.full((len(self.types), vocab_size), float("-inf"))
+        for state, token_type in enumerate(self.types):
+            allowed = allowed_types(token_type)
+            allowed_tokens = torch.isin(token_types, torch.tensor([type_index[t] for t in allowed], dtype=torch.long))
+            self.masks[state, allowed_tokens] = 0.0
+        self._device_masks = {}
+
+    def state_after(self, token_id):
+        """State of the machine after the given token"""
+        return self.token_state[token_id]
+
+    def apply_mask(self, logits, previous_token = None):
+        """Add the mask for the state after previous_token (None = nothing generated yet) to the logits, in place"""
+        state = self.start_state if previous_token is None else self.token_state[previous_token]
+        device = logits.device
+        if device not in self._device_masks:
+            self._device_masks[device] = self.masks.to(device)
+        logits += self._device_masks[device][state, :logits.size(-1)]
+        return logits
@@ -0,0 +1,30 @@
+import torch
+import torch.nn.functional as F
+
+SAMPLING_METHODS = ("top_k", "top_p", "min_p")
+
+def candidate_distribution(logits, top_k, temperature = 1.0, method = "top_k", top_p = 0.9, min_p = 0.05):
+    """
+    Turn the logits of one time step into a distribution over the top_k most likely tokens only, without touching the rest of the vocabulary.
+    method: "top_k" samples from all top_k candidates, "top_p" keeps the smallest set of candidates whose probability adds up to top_p (nucleus sampling),
+            "min_p" keeps candidates whose probability is at least min_p times that of the most likely token
+    Returns the candidate token ids [k] (most likely first) and their normalised probabilities [k], dropped candidates have probability 0
+    """
+    top_k_values, candidate_ids = torch.topk(logits, top_k) # Sorted from most to least likely
+    probs = F.softmax(top_k_values / temperature, dim=-1) # Temperature and softmax only over the k candidates
+
+    # The filters zero out probabilities instead of removing entries so that the tensor keeps its shape and nothing has to be copied back to the CPU
+    if method == "top_p":
+        keep = (probs.cumsum(-1) - probs) < top_p # Keep a candidate if the candidates before it don't already reach top_p, so the most likely one is always kept
+        probs = probs * keep
+    elif method == "min_p":
+        keep = probs >= min_p * probs[..., :1]
+        probs = probs * keep
+    elif method != "top_k":
+        raise ValueError(f"Unknown sampling method: {method}, expected one of {SAMPLING_METHODS}")
+    return candidate_ids, probs / probs.sum(-1, keepdim=True)
+
+def sample_candidate(candidate_ids, probs, generator = None):
+    """Draw one token id from the candidates, using the given torch.Generator so that seeded runs are reproducible"""
+    choice = torch.multinomial(probs, 1, generator=generator)
+    return candidate_ids[choice].item() # The only sync with the device per token
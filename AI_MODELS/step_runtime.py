@@ -0,0 +1,60 @@
+import json
+import time
+import numpy as np
+
+class StepRuntime:
+    """
+    Minimal generation runtime for a MidiLSTM exported by export_model.py, in the single-step (token, h, c) → (logits, h, c) form.
+    It only needs numpy plus either torch (TorchScript .pt) or onnxruntime (.onnx), so a worker process can generate without the training stack.
+    export_path: Path of the exported model, the settings saved next to it (<export_path>.json) describe the state shapes and special tokens
+    """
+    def __init__(self, export_path):
+        start_time = time.perf_counter()
+        with open(f"{export_path}.json") as f:
+            self.config = json.load(f)
+        self.backend = "onnx" if export_path.endswith(".onnx") else "torchscript"
+        if self.backend == "onnx":
+            import onnxruntime # Only needed for ONNX exports
+            self.session = onnxruntime.InferenceSession(export_path, providers=["CPUExecutionProvider"])
+        else:
+            import torch
+            self.torch = torch
+            self.module = torch.jit.load(export_path, map_location="cpu")
+            self.module.eval()
+        self.startup_seconds = time.perf_counter() - start_time
+
+    def initial_state(self, batch_size = 1):
+        """Zero (h, c), as the LSTM starts from"""
+        shape = (self.config["num_layers"], batch_size, self.config["hidden_size"])
+        return np.zeros(shape, dtype=np.float32), np.zeros(shape, dtype=np.float32)
+
+    def step(self, token_ids, h, c):
+        """Feed one token per batch row, returning the next-token logits [B, vocab] and the new (h, c) as numpy arrays"""
+        tokens = np.asarray(token_ids, dtype=np.int64).reshape(-1, 1)
+        if self.backend == "onnx":
+            logits, h, c = self.session.run(None, {"token": tokens, "h": h, "c": c})
+            return logits, h, c
+        with self.torch.no_grad():
+            logits, h, c = self.module(self.torch.from_numpy(tokens), self.torch.from_numpy(h), self.torch.from_numpy(c))
+        return logits.numpy(), h.numpy(), c.numpy()
+
+    def generate(self, seed_token_ids, tokens_to_gen = 100, top_k = 10, temperature = 1.0, seed = None):
+        """Prime on the seed, then sample tokens_to_gen tokens with top-k sampling. Returns the seed plus the generated tokens"""
+        rng = np.random.default_rng(seed)
+        token_ids = list(seed_token_ids)
+        h, c = self.initial_state()
+        for token_id in token_ids: # The export takes one token per call, so priming steps through the seed
+            logits, h, c = self.step([token_id], h, c)
+
+        start_time = time.perf_counter()
+        for i in range(tokens_to_gen):
+            row = logits[0].astype(np.float64) / temperature
+            candidate_ids = np.argpartition(row, -top_k)[-top_k:] # The top_k candidates (unordered)
+            probs = np.exp(row[candidate_ids] - row[candidate_ids].max())
+            next_token = int(rng.choice(candidate_ids, p=probs / probs.sum()))
+            token_ids.append(next_token)
+            if i < tokens_to_gen - 1:
+                logits, h, c = self.step([next_token], h, c)
+        elapsed = time.perf_counter() - start_time
+        self.tokens_per_second = tokens_to_gen / elapsed if elapsed > 0 else float("inf")
+        return token_ids
@@ -1,3 +1,5 @@
 from .dataset_init import MIDIDataset
 from .dataset_init_npy import MIDIDatasetNPY
-from .tokenizer_class import MidiTokenizer
\ No newline at end of file
+from .tokenizer_class import MidiTokenizer
+from .packed_corpus import PackedCorpus, PackedCorpusWriter, PackedMIDIDataset, PackedSongsDataset, collate_batch, kept_songs
+from .training_profiler import TrainingProfiler
@@ -0,0 +1,102 @@
+import time
+import argparse
+from glob import glob
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, default_collate
+from .dataset_init_npy import MIDIDatasetNPY
+from .packed_corpus import PackedCorpus, PackedMIDIDataset, PackedSongsDataset, IGNORE_INDEX
+
+def benchmark_loader_workers(file_paths, worker_counts = (0, 1, 2, 4), batch_size = 64, num_batches = 200, seq_length = 64, seed = 0, epoch = 0):
+    """
+    Samples/sec of the training DataLoader for each number of workers. Also checks that every worker count yields the exact same
+    batches (the epoch only depends on (seed, epoch)) and how many of the windows are distinct.
+    """
+    results = {}
+    reference = None
+    for num_workers in worker_counts:
+        dataset = MIDIDatasetNPY(file_paths, seq_length=seq_length, mode="train", samples_per_epoch=batch_size * num_batches, seed=seed)
+        dataset.set_epoch_files(epoch)
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+        start_time = time.perf_counter()
+        inputs = [batch_x for batch_x, _ in loader]
+        elapsed = time.perf_counter() - start_time # Includes starting the workers, as an epoch does
+
+        inputs = torch.cat(inputs)
+        if reference is None:
+            reference = inputs
+        distinct = len(torch.unique(inputs, dim=0))
+        results[num_workers] = {
+            "samples_per_second": len(inputs) / elapsed,
+            "distinct_fraction": distinct / len(inputs),
+            "matches_first": bool(torch.equal(inputs, reference)),
+        }
+
+    base = results[worker_counts[0]]["samples_per_second"]
+    for num_workers, result in results.items():
+        print(f"{num_workers:>2} workers: {result['samples_per_second']:>9.0f} samples/sec (x{result['samples_per_second'] / base:.2f}), "
+              f"{result['distinct_fraction'] * 100:.1f}% distinct windows, {'same batches' if result['matches_first'] else 'DIFFERENT batches'}")
+    return results
+
+def benchmark_batch_gather(corpus_dir, batch_size = 64, num_batches = 200, seq_length = 64, seed = 0):
+    """Batches/sec of building each batch sample by sample (__getitem__ + default_collate) against one vectorized gather (__getitems__)"""
+    dataset = PackedMIDIDataset(corpus_dir, seq_length=seq_length, mode="train", samples_per_epoch=batch_size * num_batches, seed=seed, pin_memory=False)
+    batches = np.arange(batch_size * num_batches).reshape(num_batches, batch_size).tolist()
+
+    start_time = time.perf_counter()
+    per_sample = [default_collate([dataset[i] for i in batch]) for batch in batches]
+    per_sample_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    gathered = [tuple(dataset.__getitems__(batch)) for batch in batches]
+    gathered_seconds = time.perf_counter() - start_time
+    print(f"Building {num_batches} batches of {batch_size} windows:")
+
+    identical = all(torch.equal(a[0], b[0]) and torch.equal(a[1], b[1]) for a, b in zip(per_sample, gathered))
+    print(f"  per sample: {num_batches / per_sample_seconds:>8.1f} batches/sec")
+    print(f"  one gather: {num_batches / gathered_seconds:>8.1f} batches/sec (x{per_sample_seconds / gathered_seconds:.1f}), {'identical' if identical else 'DIFFERENT'} batches")
+    return {"per_sample_batches_per_second": num_batches / per_sample_seconds, "gather_batches_per_second": num_batches / gathered_seconds, "identical": identical}
+
+def report_packing_utilization(corpus_dir, seq_length = 64, batch_size = 64, num_batches = 100, seed = 0):
+    """
+    How much of the corpus reaches the model with song-bounded windows (PackedMIDIDataset, the same windows as MIDIDatasetNPY) against BOS/EOS packing
+    (PackedSongsDataset), and the share of real song tokens among the targets of each packed batch (the rest are BOS/EOS or masked boundaries)
+    """
+    corpus = PackedCorpus(corpus_dir)
+    total_tokens = int(corpus.lengths.sum())
+
+    windowed = PackedMIDIDataset(corpus, seq_length=seq_length, pin_memory=False)
+    windowed_songs = len(windowed.eligible_songs)
+    windowed_tokens = int(corpus.lengths[windowed.eligible_songs].sum())
+
+    packed = PackedSongsDataset(corpus, seq_length=seq_length, mode="train", samples_per_epoch=batch_size * num_batches, seed=seed, mask_boundaries=True, pin_memory=False)
+    real_shares = []
+    for first in range(0, len(packed), batch_size):
+        _, targets = packed.__getitems__(range(first, min(first + batch_size, len(packed))))
+        real = (targets != IGNORE_INDEX) & (targets != packed.bos_id) & (targets != packed.eos_id)
+        real_shares.append(real.float().mean().item())
+
+    print(f"Song-bounded windows: {windowed_songs}/{len(corpus)} songs ({windowed_tokens / max(total_tokens, 1) * 100:.1f}% of tokens) can be sampled, 100.0% real tokens per batch")
+    print(f"BOS/EOS packing:      {len(corpus)}/{len(corpus)} songs (100.0% of tokens) can be sampled, "
+          f"{np.mean(real_shares) * 100:.1f}% real tokens per batch (min {np.min(real_shares) * 100:.1f}%)")
+    return {
+        "windowed_song_share": windowed_songs / max(len(corpus), 1),
+        "windowed_token_share": windowed_tokens / max(total_tokens, 1),
+        "packed_real_token_share": float(np.mean(real_shares)),
+    }
+
+if __name__ == "__main__": # Run as python -m AI_TRAINING.dataset_benchmark
+    parser = argparse.ArgumentParser(description="Benchmark the training DataLoader over different numbers of workers")
+    parser.add_argument("npy_dir", help="Directory of per-song .npy token files")
+    parser.add_argument("--corpus-dir", default=None, help="Packed corpus to also benchmark batch gathering and song packing on")
+    parser.add_argument("--seq-length", type=int, default=64)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--batches", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    benchmark_loader_workers(sorted(glob(f"{args.npy_dir}/**/*.npy", recursive=True)), args.workers, args.batch_size, args.batches, args.seq_length, seed=args.seed)
+    if args.corpus_dir is not None:
+        benchmark_batch_gather(args.corpus_dir, args.batch_size, args.batches, args.seq_length, seed=args.seed)
+        report_packing_utilization(args.corpus_dir, args.seq_length, args.batch_size, args.batches, seed=args.seed)
@@ -1,5 +1,7 @@
 import os
 import glob
+import time
+import tracemalloc
 
 import mido
 
@@ -15,25 +17,120 @@ import pandas as pd
 
 from tqdm import tqdm # For progress bars
 
+def _token_dtype(max_token):
+    return torch.int16 if max_token < 2 ** 15 else torch.int32
+
+def migrate_legacy_pairs(data, seq_length=64):
+    """
+    Rebuild the flat token buffer from a legacy list of (input_sequence, target) pairs, where target is either the input shifted by one token
+    or the single next token. Consecutive pairs whose windows overlap by all but one token are joined into one run of tokens, so each token is
+    stored once instead of up to seq_length times. Returns the dictionary MIDIDataset saves and loads
+    """
+    inputs, targets = zip(*data)
+    inputs = np.asarray(inputs, dtype=np.int64) # [N, seq_length]
+    targets = np.asarray(targets, dtype=np.int64)
+    target_is_sequence = targets.ndim == 2
+    last_tokens = targets[:, -1] if target_is_sequence else targets # The token each window adds after its input
+
+    # A window continues the previous run if it is the previous window moved on by one token
+    continues = np.zeros(len(inputs), dtype=bool)
+    continues[1:] = (inputs[1:, :-1] == inputs[:-1, 1:]).all(axis=1) & (inputs[1:, -1] == last_tokens[:-1])
+    run_starts = np.flatnonzero(~continues)
+
+    runs = []
+    for run_index, first in enumerate(run_starts):
+        last = run_starts[run_index + 1] if run_index + 1 < len(run_starts) else len(inputs)
+        runs.append(inputs[first]) # The first window's input, then one new token per window
+        runs.append(last_tokens[first:last])
+    tokens = np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+
+    # Each run of k windows takes seq_length + k tokens, and its windows start one token apart
+    run_lengths = np.diff(np.append(run_starts, len(inputs)))
+    run_offsets = np.concatenate([[0], np.cumsum(run_lengths + seq_length)[:-1]])
+    starts = np.repeat(run_offsets - run_starts, run_lengths) + np.arange(len(inputs))
+
+    windows = tokens[starts[:, None] + np.arange(seq_length + 1)]
+    if not (np.array_equal(windows[:, :-1], inputs) and np.array_equal(windows[:, 1:] if target_is_sequence else windows[:, -1], targets)):
+        raise ValueError("Migrated windows don't match the legacy pairs")
+
+    return {
+        "tokens": torch.from_numpy(tokens).to(_token_dtype(tokens.max(initial=0))),
+        "starts": torch.from_numpy(starts),
+        "seq_length": seq_length,
+        "target": "sequence" if target_is_sequence else "token",
+    }
+
+def migrate_dataset_file(legacy_file, output_file, seq_length=64):
+    """One-time conversion of a legacy pickled list of pairs into the compact format"""
+    data = torch.load(legacy_file)
+    store = migrate_legacy_pairs(data, seq_length)
+    torch.save(store, output_file)
+    print(f"Migrated {len(data)} pairs into {len(store['tokens'])} tokens ({output_file})")
+    return output_file
+
 class MIDIDataset(Dataset):
+    """
+    Training pairs stored as one flat token buffer plus the start of every window in it. Inputs and targets are slices of the buffer,
+    so overlapping windows share their tokens.
+    tokens_file: A file saved by migrate_dataset_file (a legacy pickled list of pairs is also accepted, and migrated in memory on load)
+    """
     def __init__(self, tokens_file, seq_length=64):
         self.seq_length = seq_length
-        self.data = torch.load(tokens_file)
+        store = torch.load(tokens_file)
+        if isinstance(store, (list, tuple)):
+            print(f"{tokens_file} is in the legacy format, migrating in memory (save it with migrate_dataset_file to skip this)")
+            store = migrate_legacy_pairs(store, seq_length)
+        self.tokens = store["tokens"]
+        self.starts = store["starts"]
+        self.target_is_sequence = store["target"] == "sequence"
 
     def __len__(self):
-        return len(self.data)
+        return len(self.starts)
 
     def __getitem__(self, idx):
-        input_sequence, target_sequence = self.data[idx]
-        input_sequence = torch.tensor(input_sequence, dtype=torch.long)
-        target_sequence = torch.tensor(target_sequence, dtype=torch.long)
+        start = self.starts[idx]
+        window = self.tokens[start:start + self.seq_length + 1].long()
+        input_sequence = window[:-1]
+        target_sequence = window[1:] if self.target_is_sequence else window[-1]
 
         return input_sequence, target_sequence
     
     def clear(self):
-        self.data = []
+        self.tokens = self.tokens[:0]
+        self.starts = self.starts[:0]
+
+    def windows(self, start = 0, stop = None):
+        """
+        Windows start to stop (all of them by default) as a [num_windows, seq_length + 1] tensor in the buffer's dtype.
+        unfold is a strided view of the buffer, but picking the windows by their starts copies them, so large ranges are best taken a chunk at a time
+        """
+        return self.tokens.unfold(0, self.seq_length + 1, 1)[self.starts[start:stop]]
+
+    def split_X_y(self, chunk_size = 65536):
+        """
+        Inputs and targets of every window, as views of one int64 copy of all the windows (the model's embedding needs int64 ids).
+        The copy is filled chunk_size windows at a time, so the windows are never also gathered in full in the buffer's dtype
+        """
+        windows = torch.empty((len(self.starts), self.seq_length + 1), dtype=torch.long)
+        for start in range(0, len(self.starts), chunk_size):
+            windows[start:start + chunk_size] = self.windows(start, start + chunk_size)
+        return windows[:, :-1], windows[:, 1:] if self.target_is_sequence else windows[:, -1]
+
+def compare_dataset_formats(legacy_file, compact_file, seq_length=64):
+    """Load time and memory of the legacy pickled pairs against the compact token buffer"""
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    legacy = torch.load(legacy_file)
+    legacy_seconds = time.perf_counter() - start_time
+    legacy_bytes = tracemalloc.get_traced_memory()[0] # Python objects: the list, the tuples, the inner lists and their ints
+    tracemalloc.stop()
+    del legacy
+
+    start_time = time.perf_counter()
+    dataset = MIDIDataset(compact_file, seq_length)
+    compact_seconds = time.perf_counter() - start_time
+    compact_bytes = dataset.tokens.nbytes + dataset.starts.nbytes
 
-    def split_X_y(self):
-        X, y = zip(*self.data)
-        return torch.stack([torch.tensor(x, dtype=torch.long)for x in X]), torch.tensor(y, dtype=torch.long)
-    
\ No newline at end of file
+    print(f"Legacy pairs:  {legacy_seconds:.2f}s to load, {legacy_bytes / 2 ** 20:.1f} MiB")
+    print(f"Token buffer:  {compact_seconds:.2f}s to load, {compact_bytes / 2 ** 20:.1f} MiB ({legacy_bytes / max(compact_bytes, 1):.0f}x smaller)")
+    return {"legacy_seconds": legacy_seconds, "legacy_bytes": legacy_bytes, "compact_seconds": compact_seconds, "compact_bytes": compact_bytes}
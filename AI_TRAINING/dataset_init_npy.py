@@ -1,27 +1,95 @@
 import os
+import json
 import numpy as np
 import torch
 from torch.utils.data import Dataset
 from glob import glob
 from tqdm import tqdm # For progress bars
+from .packed_corpus import kept_songs
+
+LENGTHS_INDEX_FILE = "token_lengths.json" # Saved in each token directory: the token count of every .npy file, with the size and mtime it was read at
+
+def npy_length(path):
+    """Number of tokens in a .npy file, read from its header without loading or mapping the array"""
+    with open(path, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, _, _ = read_header(f)
+    return shape[0]
+
+def token_lengths(paths):
+    """
+    Token count of every file, from the index saved next to the files. Only files that are new or whose size/mtime changed are read,
+    and the index is rewritten when anything was added.
+    """
+    paths_by_dir = {}
+    for path in paths:
+        paths_by_dir.setdefault(os.path.dirname(os.path.abspath(path)), []).append(path)
+
+    lengths = {}
+    for directory, dir_paths in paths_by_dir.items():
+        index_path = os.path.join(directory, LENGTHS_INDEX_FILE)
+        index = {}
+        if os.path.exists(index_path):
+            try:
+                with open(index_path) as f:
+                    index = json.load(f)
+            except (OSError, json.JSONDecodeError): # A damaged index is rebuilt
+                index = {}
+
+        changed = False
+        for path in tqdm(dir_paths, desc="Indexing token files", disable=len(dir_paths) - len(index) < 1000):
+            name = os.path.basename(path)
+            stat = os.stat(path)
+            entry = index.get(name)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+                entry = {"size": stat.st_size, "mtime": stat.st_mtime, "length": npy_length(path)}
+                index[name] = entry
+                changed = True
+            lengths[path] = entry["length"]
+
+        if changed:
+            try:
+                with open(index_path + ".tmp", "w") as f:
+                    json.dump(index, f)
+                os.replace(index_path + ".tmp", index_path) # Never leaves a half-written index behind
+            except OSError: # Read-only data, the lengths are just recomputed next time
+                pass
+    return [lengths[path] for path in paths]
 
 class MIDIDatasetNPY(Dataset):
-    def __init__(self, all_file_paths, seq_length=64, mode = "train", samples_per_epoch = 50000, files_per_epoch = 5000):
+    def __init__(self, all_file_paths, seq_length=64, mode = "train", samples_per_epoch = 50000, files_per_epoch = 5000, seed = 0, manifest = None):
         self.seq_length = seq_length
         self.mode = mode
         self.samples_per_epoch = samples_per_epoch
         self.files_per_epoch = files_per_epoch
 
+        if manifest is not None:
+            # Only files the dedup manifest kept (its sources are relative to the data directory it records, or to its own directory for older manifests)
+            manifest_dir = os.path.dirname(os.path.abspath(manifest))
+            kept = {os.path.normpath(os.path.join(row.get("data_dir") or manifest_dir, row["source"])) for row in kept_songs(manifest)}
+            kept_paths = [path for path in all_file_paths if os.path.normpath(os.path.abspath(path)) in kept]
+            if all_file_paths and not kept_paths:
+                raise ValueError(f"The manifest {manifest} keeps none of the {len(all_file_paths)} input files: was it written for another data directory?")
+            all_file_paths = kept_paths
+
         self.all_file_paths = all_file_paths
         self.file_paths = all_file_paths
 
+        # The files and windows of a training epoch only depend on (seed, epoch), so every DataLoader worker builds the same plan
+        # and reads its own indices of it: no duplicate samples between workers, and the same batches for any number of workers
+        self.seed = seed
+        self.epoch = 0
+        self._next_epoch = 0
+        self._file_lengths = dict(zip(all_file_paths, token_lengths(all_file_paths))) # Token count of each file, from the saved index
+        self._plan_epoch = None
+        self._plan = None
+        if mode == "train":
+            self._check_has_windows(all_file_paths, "input files")
+
         # Precompute sequence counts for deterministic val/test
         if mode in ["val", "test"]:
-            self.file_sequence_counts = []
-            for path in tqdm(self.file_paths, desc=f"Counting sequences ({mode})"):
-                tokens = np.load(path, mmap_mode='r')
-                count = max(len(tokens) - seq_length, 0)
-                self.file_sequence_counts.append(count)
+            self.file_sequence_counts = [max(self._file_lengths[path] - seq_length, 0) for path in self.file_paths]
             self.total_sequences = sum(self.file_sequence_counts)
             self.cumulative_counts = np.cumsum([0] + self.file_sequence_counts)
 
@@ -29,17 +97,48 @@ class MIDIDatasetNPY(Dataset):
         self._cached_file_idx = None
         self._cached_tokens = None
 
+    def _epoch_rng(self, stream):
+        """Generator for this epoch, stream 0 picks the files and stream 1 the windows"""
+        return np.random.default_rng(np.random.SeedSequence([self.seed, self.epoch]).spawn(2)[stream])
+
     def _sample_files(self):
         # Randomly select files for this epoch to reduce training time slightly
-        paths = np.random.choice(self.all_file_paths, min(self.files_per_epoch, len(self.all_file_paths)), replace=False) # Will choose "files_per_epoch" number of files to be used this epoch
-        return list(paths)
+        n_files = min(self.files_per_epoch, len(self.all_file_paths)) # Will choose "files_per_epoch" number of files to be used this epoch
+        file_indices = self._epoch_rng(0).choice(len(self.all_file_paths), n_files, replace=False)
+        return [self.all_file_paths[i] for i in file_indices]
+
+    def _lengths_of(self, paths):
+        return np.array([self._file_lengths[path] for path in paths], dtype=np.int64)
+
+    def _check_has_windows(self, paths, description):
+        """Training windows need seq_length + 1 tokens, so at least one file must be longer than seq_length"""
+        if not (self._lengths_of(paths) > self.seq_length).any():
+            raise ValueError(f"None of the {len(paths)} {description} has more than seq_length={self.seq_length} tokens, so there are no training windows")
 
-    def set_epoch_files(self):
+    def set_epoch_files(self, epoch = None):
+        """Choose the files for an epoch (the next one if epoch is None, pass it explicitly when resuming from a checkpoint)"""
         if self.mode == "train":
+            self.epoch = self._next_epoch if epoch is None else epoch
+            self._next_epoch = self.epoch + 1
             self.file_paths = self._sample_files()
+            self._check_has_windows(self.file_paths, f"files picked for epoch {self.epoch} (files_per_epoch={self.files_per_epoch})")
+            self._plan_epoch = None
+            self._plan = None
             self._cached_file_idx = None
             self._cached_tokens = None
 
+    def _window_plan(self):
+        """File index and start of every training sample this epoch"""
+        if self._plan_epoch != self.epoch:
+            window_counts = np.maximum(self._lengths_of(self.file_paths) - self.seq_length, 0) # Windows need seq_length + 1 tokens
+            eligible_files = np.flatnonzero(window_counts > 0) # Files that are too short are never picked, so there is no retry loop
+            rng = self._epoch_rng(1)
+            file_indices = eligible_files[rng.integers(len(eligible_files), size=self.samples_per_epoch)]
+            starts = rng.integers(0, window_counts[file_indices])
+            self._plan = (file_indices, starts)
+            self._plan_epoch = self.epoch
+        return self._plan
+
     def __len__(self):
         if self.mode == "train":
             return self.samples_per_epoch
@@ -48,16 +147,12 @@ class MIDIDatasetNPY(Dataset):
 
     def __getitem__(self, idx):
         if self.mode == "train":
-            # Randomly pick a file and sequence
-            while True:
-                file_idx = np.random.randint(len(self.file_paths))
-                tokens = np.load(self.file_paths[file_idx], mmap_mode='r')
-                if len(tokens) <= self.seq_length:
-                    continue
-                start = np.random.randint(0, len(tokens) - self.seq_length - 1)
-                input_seq = tokens[start:start + self.seq_length]
-                target_seq = tokens[start + 1:start + self.seq_length + 1]
-                break
+            # Window idx of this epoch's plan
+            file_indices, starts = self._window_plan()
+            tokens = np.load(self.file_paths[file_indices[idx]], mmap_mode='r')
+            start = starts[idx]
+            input_seq = tokens[start:start + self.seq_length]
+            target_seq = tokens[start + 1:start + self.seq_length + 1]
         else:
             # Deterministic val/test
             file_idx = np.searchsorted(self.cumulative_counts, idx, side='right') - 1
@@ -75,4 +170,30 @@ class MIDIDatasetNPY(Dataset):
             input_seq = tokens[seq_idx:seq_idx + self.seq_length]
             target_seq = tokens[seq_idx + 1:seq_idx + self.seq_length + 1]
 
-        return torch.tensor(input_seq, dtype=torch.long), torch.tensor(target_seq, dtype=torch.long)
\ No newline at end of file
+        return torch.tensor(input_seq, dtype=torch.long), torch.tensor(target_seq, dtype=torch.long)
+
+    def iter_batches(self, batch_size = 64):
+        """
+        Val/test batches in index order, the same batches as a DataLoader with shuffle=False, but each file is opened once
+        and its windows are read in order through one strided view instead of one lookup and slice per index
+        """
+        if self.mode == "train":
+            raise ValueError("iter_batches is for val/test mode, training windows are random")
+        batch = torch.empty((batch_size, self.seq_length + 1), dtype=torch.long)
+        filled = 0
+        for path, count in zip(self.file_paths, self.file_sequence_counts):
+            if count == 0:
+                continue
+            windows = np.lib.stride_tricks.sliding_window_view(np.load(path, mmap_mode='r'), self.seq_length + 1)[:count] # Every window of the file, no copy
+            done = 0
+            while done < count:
+                take = min(batch_size - filled, count - done)
+                batch[filled:filled + take] = torch.from_numpy(np.array(windows[done:done + take])) # Always a writable copy (a single window of a read-only memmap would otherwise stay a view)
+                filled += take
+                done += take
+                if filled == batch_size:
+                    yield batch[:, :-1], batch[:, 1:]
+                    batch = torch.empty((batch_size, self.seq_length + 1), dtype=torch.long) # The yielded batch may still be in use
+                    filled = 0
+        if filled > 0:
+            yield batch[:filled, :-1], batch[:filled, 1:]
@@ -0,0 +1,243 @@
+import os
+import csv
+import sys
+import shutil
+import sqlite3
+import hashlib
+import argparse
+from glob import glob
+from collections import Counter
+from multiprocessing import Pool
+import numpy as np
+from tqdm import tqdm
+from packed_corpus import PackedCorpus, INFO_FILE, DEDUP_MANIFEST_FILE
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # This script runs from its own folder, the SHARED package is in the repo root
+from SHARED import PoolRun
+
+data_dir = r"C:\tempp\MELODY_TOKENS" # A packed corpus or a directory of per-song .npy token files, as written by tokenize_dataset.py
+
+NUM_PERM = 128 # MinHash signature length
+NGRAM = 5 # Tokens per shingle
+MERSENNE_PRIME = (1 << 61) - 1
+_HASH_A, _HASH_B = np.random.default_rng(1).integers(1, 1 << 31, size=(2, NUM_PERM, 1), dtype=np.uint64) # Fixed, so signatures from different runs can be compared
+_NGRAM_WEIGHTS = np.array([pow(0x9E3779B97F4A7C15, i, 1 << 64) for i in range(NGRAM)], dtype=np.uint64) # Polynomial hash of an n-gram, wrapping modulo 2^64
+
+INDEX_DIR = "dedup_index" # Disk-backed LSH buckets and signatures, next to the data
+MANIFEST_FIELDS = ["song_id", "data_dir", "source", "sha1", "num_tokens", "unique_tokens", "top_token_share", "ngram_diversity", "status", "duplicate_of", "cluster", "reason"]
+
+# Songs with any of these token statistics are dropped as degenerate
+QUALITY_LIMITS = {
+    "min_tokens": 32, # Too short to learn anything from
+    "min_unique_tokens": 8, # Almost no distinct events (a held note, a drum loop)
+    "max_top_token_share": 0.5, # One token is most of the song
+    "min_ngram_diversity": 0.05, # The same few n-grams over and over
+}
+
+_corpus = None # Opened once per worker when the input is a packed corpus
+
+def _init_worker(corpus_dir):
+    global _corpus
+    _corpus = PackedCorpus(corpus_dir) if corpus_dir is not None else None
+
+def ngram_hashes(tokens):
+    """Distinct 32-bit hashes of a song's token n-grams (a song shorter than NGRAM is one shingle)"""
+    n = min(NGRAM, len(tokens))
+    if n == 0:
+        return np.zeros(0, dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(tokens.astype(np.uint64), n)
+    with np.errstate(over="ignore"):
+        hashes = (windows * _NGRAM_WEIGHTS[:n]).sum(axis=1)
+    return np.unique((hashes ^ (hashes >> np.uint64(32))) & np.uint64(0xFFFFFFFF))
+
+def minhash_signature(shingles):
+    """Minimum of NUM_PERM universal hashes (a * x + b) mod p over the shingles: two songs agree on a signature entry with probability equal to their Jaccard similarity"""
+    if len(shingles) == 0:
+        return np.full(NUM_PERM, MERSENNE_PRIME, dtype=np.uint64)
+    return ((_HASH_A * shingles + _HASH_B) % np.uint64(MERSENNE_PRIME)).min(axis=1)
+
+def token_stats(tokens, shingles):
+    counts = np.bincount(tokens.astype(np.int64)) if len(tokens) else np.zeros(1, dtype=np.int64)
+    num_ngrams = max(len(tokens) - NGRAM + 1, 1)
+    return {
+        "num_tokens": len(tokens),
+        "unique_tokens": int(np.count_nonzero(counts)),
+        "top_token_share": float(counts.max() / len(tokens)) if len(tokens) else 1.0,
+        "ngram_diversity": len(shingles) / num_ngrams,
+    }
+
+def quality_reason(stats, limits = QUALITY_LIMITS):
+    """Why a song's token statistics are degenerate, or "" if they aren't"""
+    if stats["num_tokens"] < limits["min_tokens"]:
+        return "too_short"
+    if stats["unique_tokens"] < limits["min_unique_tokens"]:
+        return "few_unique_tokens"
+    if stats["top_token_share"] > limits["max_top_token_share"]:
+        return "dominant_token"
+    if stats["ngram_diversity"] < limits["min_ngram_diversity"]:
+        return "repetitive"
+    return ""
+
+def analyse_song(task):
+    """Content hash, token statistics and MinHash signature of one song in a worker, or the error that stopped it"""
+    index, source, path = task
+    result = {"index": index, "path": source}
+    try:
+        tokens = _corpus.song(index) if _corpus is not None else np.load(path)
+        tokens = np.ascontiguousarray(tokens, dtype=np.int32) # Same bytes whatever dtype the tokens were saved with
+        shingles = ngram_hashes(tokens)
+        result.update(sha1=hashlib.sha1(tokens.tobytes()).hexdigest(), stats=token_stats(tokens, shingles), signature=minhash_signature(shingles))
+    except Exception as e:
+        result["error"] = type(e).__name__
+        result["message"] = str(e)
+    return result
+
+def lsh_bands(threshold, num_perm = NUM_PERM):
+    """Bands and rows per band whose S-curve (1/bands)^(1/rows) is closest to the threshold without going over it, so few true near-duplicates are missed"""
+    options = [(num_perm // rows, rows) for rows in range(1, num_perm + 1) if num_perm % rows == 0]
+    below = [option for option in options if (1 / option[0]) ** (1 / option[1]) <= threshold]
+    return max(below or options[:1], key=lambda option: (1 / option[0]) ** (1 / option[1]))
+
+def _band_hash(values):
+    return int.from_bytes(hashlib.blake2b(values.tobytes(), digest_size=8).digest(), "little", signed=True) # Fits an sqlite INTEGER
+
+class UnionFind:
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        root = x
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while x != root: # Path compression
+            self.parent[x], x = root, self.parent.get(x, x)
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+def _list_songs(data_dir):
+    """(song index, source, path) of every song, from a packed corpus or a directory of .npy files"""
+    if os.path.exists(os.path.join(data_dir, INFO_FILE)):
+        corpus = PackedCorpus(data_dir)
+        return [(i, source, None) for i, source in enumerate(corpus.sources())], data_dir
+    paths = sorted(path for path in glob(os.path.join(data_dir, "**", "*.npy"), recursive=True) if INDEX_DIR not in os.path.relpath(path, data_dir).split(os.sep))
+    return [(i, os.path.relpath(path, data_dir), path) for i, path in enumerate(paths)], None
+
+def dedup_corpus(data_dir, manifest_path = None, threshold = 0.8, num_workers = None, limits = QUALITY_LIMITS):
+    """
+    Drop exact duplicates (same token sha1), degenerate songs (see QUALITY_LIMITS) and near-duplicates (estimated Jaccard similarity of token
+    n-grams >= threshold, found through MinHash LSH) from a tokenized corpus. Near-duplicates are clustered and the longest song of each cluster is kept.
+    Nothing is deleted: every song gets a row in the manifest (dedup_manifest.csv in data_dir by default), which the dataset classes read with manifest=...
+    Songs that can't be read are marked "failed" (with the error as the reason) instead of stopping the run.
+    """
+    run = PoolRun()
+    manifest_path = manifest_path or os.path.join(data_dir, DEDUP_MANIFEST_FILE)
+    songs, corpus_dir = _list_songs(data_dir)
+    num_songs = len(songs)
+
+    # The index lives on disk so memory stays flat for hundreds of thousands of songs
+    index_dir = os.path.join(data_dir, INDEX_DIR)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.makedirs(index_dir)
+    signatures = np.memmap(os.path.join(index_dir, "signatures.bin"), dtype=np.uint64, mode="w+", shape=(max(num_songs, 1), NUM_PERM))
+    shas = [""] * num_songs
+    stats = [{}] * num_songs # Failed songs keep no statistics
+    status = ["kept"] * num_songs
+    duplicate_of = [None] * num_songs
+    reasons = [""] * num_songs
+    with Pool(num_workers, initializer=_init_worker, initargs=(corpus_dir,)) as pool:
+        for result in tqdm(pool.imap_unordered(analyse_song, songs, chunksize=64), total=num_songs, desc="Hashing songs"):
+            index = result["index"]
+            if not run.record(result):
+                status[index] = "failed"
+                reasons[index] = result["error"]
+                continue
+            shas[index] = result["sha1"]
+            stats[index] = result["stats"]
+            signatures[index] = result["signature"]
+
+    # Exact duplicates: the first song with each hash is kept
+    first_with_hash = {}
+    for index in range(num_songs):
+        if status[index] == "failed":
+            continue
+        if shas[index] in first_with_hash:
+            status[index] = "exact_duplicate"
+            duplicate_of[index] = first_with_hash[shas[index]]
+        else:
+            first_with_hash[shas[index]] = index
+
+    for index in range(num_songs):
+        if status[index] == "kept":
+            reasons[index] = quality_reason(stats[index], limits)
+            if reasons[index]:
+                status[index] = "filtered"
+
+    # Near duplicates: songs sharing any LSH band are candidates, and a candidate pair is only joined if its signatures really agree
+    bands, rows = lsh_bands(threshold)
+    connection = sqlite3.connect(os.path.join(index_dir, "lsh.sqlite"))
+    connection.execute("CREATE TABLE buckets (band INTEGER, hash INTEGER, song INTEGER)")
+    candidates = [index for index in range(num_songs) if status[index] == "kept"]
+    for chunk_start in range(0, len(candidates), 10000):
+        connection.executemany("INSERT INTO buckets VALUES (?, ?, ?)", (
+            (band, _band_hash(signatures[index, band * rows:(band + 1) * rows]), index)
+            for index in candidates[chunk_start:chunk_start + 10000] for band in range(bands)
+        ))
+    connection.commit()
+    connection.execute("CREATE INDEX bucket_index ON buckets (band, hash)")
+
+    clusters = UnionFind()
+    pairs = connection.execute("SELECT DISTINCT a.song, b.song FROM buckets a JOIN buckets b ON a.band = b.band AND a.hash = b.hash AND a.song < b.song")
+    for a, b in pairs:
+        if clusters.find(a) != clusters.find(b) and np.mean(signatures[a] == signatures[b]) >= threshold:
+            clusters.union(a, b)
+    connection.close()
+
+    members = {}
+    for index in candidates:
+        members.setdefault(clusters.find(index), []).append(index)
+    cluster_ids = {}
+    for cluster_id, group in enumerate(group for group in members.values() if len(group) > 1):
+        keep = max(group, key=lambda index: (stats[index]["num_tokens"], -index)) # Longest song, then the first one
+        for index in group:
+            cluster_ids[index] = cluster_id
+            if index != keep:
+                status[index] = "near_duplicate"
+                duplicate_of[index] = keep
+
+    with open(manifest_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_FIELDS)
+        writer.writeheader()
+        for index, source, _ in songs:
+            writer.writerow({
+                "song_id": index if corpus_dir is not None else "",
+                "data_dir": os.path.abspath(data_dir), # Sources are relative to it, wherever the manifest is written
+                "source": source,
+                "sha1": shas[index],
+                **stats[index],
+                "status": status[index],
+                "duplicate_of": songs[duplicate_of[index]][1] if duplicate_of[index] is not None else "",
+                "cluster": cluster_ids.get(index, ""),
+                "reason": reasons[index],
+            })
+
+    counts = Counter(status)
+    run.finish()
+    run.report(f"Analysed {run.done} of {num_songs} songs (LSH with {bands} bands of {rows} rows)")
+    filter_reasons = Counter(reason for index, reason in enumerate(reasons) if status[index] == "filtered")
+    print(f"Kept {counts['kept']}, exact duplicates {counts['exact_duplicate']}, near duplicates {counts['near_duplicate']} in {len(set(cluster_ids.values()))} clusters, filtered {counts['filtered']}"
+          + (" (" + ", ".join(f"{reason}: {count}" for reason, count in filter_reasons.most_common()) + ")" if counts["filtered"] else "")
+          + (f", failed {counts['failed']}" if counts["failed"] else ""))
+    print(f"Manifest written to {manifest_path}")
+    return dict(counts)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find exact duplicates, near-duplicates and degenerate songs in a tokenized corpus and write a manifest of which songs to keep")
+    parser.add_argument("--data-dir", default=data_dir, help="Packed corpus or directory of .npy token files")
+    parser.add_argument("--manifest", default=None, help=f"Where to write the manifest (defaults to {DEDUP_MANIFEST_FILE} in the data directory)")
+    parser.add_argument("--threshold", type=float, default=0.8, help="Estimated Jaccard similarity above which two songs are near-duplicates")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (defaults to the number of CPUs)")
+    args = parser.parse_args()
+    dedup_corpus(args.data_dir, args.manifest, args.threshold, args.workers)
@@ -1,12 +1,8 @@
 from pathlib import Path
 from glob import glob
-from miditok import REMI
 from miditoolkit import MidiFile
 from tqdm import tqdm
 
-# Initialize tokenizer
-tokenizer = REMI()
-
 def pick_main_melody_track(midi: MidiFile):
     """Heuristic to pick the main melody/accompaniment track based on average pitch and note density"""
     # As many songs have chords within the melodies, the accompaniment may share the same track
@@ -68,10 +64,11 @@ def preprocess_midi_dataset(dataset_dir: str,save_melody_dir: str):
             print(f"Skipping {Path(path).name} due to error: {e}")
     return total_files_tokenized
 
-# Extract melodies from MIDI dataset
-dataset_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET"
-save_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET_ACCOMPANIMENT"
+if __name__ == "__main__": # Only run the extraction when this file is run directly, so its functions can be imported (see extract_tracks.py)
+    # Extract melodies from MIDI dataset
+    dataset_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET"
+    save_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET_ACCOMPANIMENT"
 
-tokens_dataset = preprocess_midi_dataset(dataset_folder, save_melody_dir=save_folder)
+    tokens_dataset = preprocess_midi_dataset(dataset_folder, save_melody_dir=save_folder)
 
-print(f"Processed {tokens_dataset} accompaniment tracks.")
\ No newline at end of file
+    print(f"Processed {tokens_dataset} accompaniment tracks.")
\ No newline at end of file
@@ -1,11 +1,11 @@
+import os
+import sys
 from pathlib import Path
 from glob import glob
-from miditok import REMI
 from miditoolkit import MidiFile
 from tqdm import tqdm
-
-# Initialize tokenizer
-tokenizer = REMI()
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # This script runs from its own folder, the SHARED package is in the repo root
+from SHARED import flatten_notes
 
 def pick_main_melody_track(midi: MidiFile):
     """Heuristic to pick the main melody track based on average pitch and note density"""
@@ -38,34 +38,8 @@ def flatten_melody(midi: MidiFile):
     """Make the melody monophonic by removing overlapping notes. Higher pitch notes are prioritised."""
     # This is so that the ai model will only train on the melody, ensuring that it is possible to learn how to generate melodies that sound good
     for track in midi.instruments:
-        if not track.notes:
-            continue
-        # Sort notes by start time, and then by pitch (descending so it uses the higher note) for notes starting at the same time
-        notes = sorted(track.notes, key=lambda n: (n.start, -n.pitch))
-        flattened_notes = [] # List to hold the flattened notes
-        active_note = None
-
-        # Iterate through sorted notes and add to flattened list if they don't overlap
-        for note in notes:
-            if active_note is None:
-                # Start with the first note
-                active_note = note
-                flattened_notes.append(active_note)
-            else:
-                if note.start == active_note.start:
-                    # If multiple notes start at the same time, keep the higher pitch note to remove chords
-                    continue
-                if note.start < active_note.end:
-                    # If new note is higher pitch and overlaps, cut the active note short
-                    if note.pitch > active_note.pitch:
-                        active_note.end = note.start
-                        active_note = note
-                        flattened_notes.append(active_note)
-                    #Otherwise, skip the overlapping note
-                else:
-                    flattened_notes.append(note) # Add note if it doesn't overlap
-                    active_note = note
-        track.notes = flattened_notes # Replace the track's notes with the flattened melody
+        if track.notes:
+            track.notes = flatten_notes(track.notes) # Replace the track's notes with the flattened melody
     return midi
 
 def preprocess_midi_dataset(dataset_dir: str,save_melody_dir: str):  
@@ -102,10 +76,11 @@ def preprocess_midi_dataset(dataset_dir: str,save_melody_dir: str):
             print(f"Skipping {Path(path).name} due to error: {e}")
     return total_files_tokenized
 
-# Extract melodies from MIDI dataset
-dataset_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET"
-save_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET_MELODY"
+if __name__ == "__main__": # Only run the extraction when this file is run directly, so its functions can be imported (see extract_tracks.py)
+    # Extract melodies from MIDI dataset
+    dataset_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET"
+    save_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET_MELODY"
 
-tokens_dataset = preprocess_midi_dataset(dataset_folder, save_melody_dir=save_folder)
+    tokens_dataset = preprocess_midi_dataset(dataset_folder, save_melody_dir=save_folder)
 
-print(f"Processed {tokens_dataset} melody tracks.")
\ No newline at end of file
+    print(f"Processed {tokens_dataset} melody tracks.")
\ No newline at end of file
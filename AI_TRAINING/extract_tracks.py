@@ -0,0 +1,109 @@
+import os
+import io
+import sys
+import copy
+import argparse
+from glob import glob
+from pathlib import Path
+from multiprocessing import Pool
+import numpy as np
+from miditoolkit import MidiFile
+from symusic import Score
+from tqdm import tqdm
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # This script runs from its own folder, the SHARED package is in the repo root
+from extractMelodies import pick_main_melody_track as pick_melody_track, remove_leading_silence, flatten_melody
+from extractAccompaniment import pick_main_melody_track as pick_accompaniment_track
+from tokenizer_class import MidiTokenizer
+from packed_corpus import PackedCorpusWriter
+from SHARED import PoolRun
+
+dataset_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET"
+melody_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET_MELODY"
+accompaniment_folder = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET_ACCOMPANIMENT"
+
+_tokenizer = None # One tokenizer per worker process, only when tokenizing straight to the training format
+
+def _init_worker(tokenize):
+    global _tokenizer
+    _tokenizer = MidiTokenizer() if tokenize else None
+
+def _single_track_copy(midi: MidiFile, track):
+    """A MidiFile with the same header (tempo, time signatures, ticks per beat) and a copy of one track, so the parsed file can be reused for both outputs"""
+    single = copy.copy(midi)
+    single.instruments = [copy.deepcopy(track)]
+    return single
+
+def split_melody_accompaniment(midi: MidiFile):
+    """Melody-only and accompaniment-only versions of one parsed file, with the same processing as extractMelodies.py and extractAccompaniment.py"""
+    melody = _single_track_copy(midi, pick_melody_track(midi))
+    melody = flatten_melody(remove_leading_silence(melody))
+
+    accompaniment = _single_track_copy(midi, pick_accompaniment_track(midi))
+    accompaniment = remove_leading_silence(accompaniment)
+    return melody, accompaniment
+
+def _tokenize(midi: MidiFile):
+    """Tokenize a MidiFile in memory, without writing it to disk first"""
+    buffer = io.BytesIO()
+    midi.dump(file=buffer)
+    tokens = _tokenizer.tokenizer(Score.from_midi(buffer.getvalue()))
+    token_ids = tokens[0].ids if isinstance(tokens, list) else tokens.ids
+    return np.array(token_ids, dtype=np.int16)
+
+def process_file(task):
+    """Parse one file once and produce both outputs: MIDI files, or token arrays returned to the main process"""
+    path, relative_path, melody_dir, accompaniment_dir = task
+    result = {"path": relative_path}
+    try:
+        midi = MidiFile(path, clip=True)
+        melody, accompaniment = split_melody_accompaniment(midi)
+        if _tokenizer is not None:
+            result["melody"] = _tokenize(melody)
+            result["accompaniment"] = _tokenize(accompaniment)
+        else:
+            # Same names as the separate scripts used: "_melody"/"_acc" before the extension, keeping the folder structure
+            relative = Path(relative_path)
+            for output, output_dir, suffix in ((melody, melody_dir, "_melody"), (accompaniment, accompaniment_dir, "_acc")):
+                save_path = Path(output_dir) / relative.parent / f"{relative.stem}{suffix}{relative.suffix}"
+                save_path.parent.mkdir(parents=True, exist_ok=True)
+                output.dump(save_path)
+    except Exception as e:
+        result["error"] = type(e).__name__
+        result["message"] = str(e)
+    return result
+
+def extract_tracks(dataset_dir, melody_dir, accompaniment_dir, tokenize = False, num_workers = None):
+    """
+    Extract melody and accompaniment tracks from every MIDI file in one pass over the dataset, across a pool of worker processes.
+    tokenize: Write packed token corpora (see packed_corpus.py) into melody_dir and accompaniment_dir instead of MIDI files
+    """
+    midi_paths = glob(f"{dataset_dir}/**/*.mid", recursive=True)
+    tasks = [(path, os.path.relpath(path, dataset_dir), melody_dir, accompaniment_dir) for path in midi_paths]
+    writers = {"melody": PackedCorpusWriter(melody_dir), "accompaniment": PackedCorpusWriter(accompaniment_dir)} if tokenize else None
+
+    run = PoolRun()
+    with Pool(num_workers, initializer=_init_worker, initargs=(tokenize,)) as pool:
+        for result in tqdm(pool.imap_unordered(process_file, tasks, chunksize=8), total=len(tasks), desc="Processing MIDI files", unit="file"):
+            if not run.record(result):
+                continue
+            if writers is not None:
+                for part, writer in writers.items():
+                    if len(result[part]) > 0:
+                        writer.add(result[part], source=result["path"])
+    if writers is not None:
+        for writer in writers.values():
+            writer.close()
+
+    run.finish()
+    run.report(f"Processed {run.done} files into melody and accompaniment tracks")
+    return run.done
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract melody and accompaniment tracks from a MIDI dataset in a single pass")
+    parser.add_argument("--dataset-dir", default=dataset_folder)
+    parser.add_argument("--melody-dir", default=melody_folder)
+    parser.add_argument("--accompaniment-dir", default=accompaniment_folder)
+    parser.add_argument("--tokenize", action="store_true", help="Tokenize straight into packed corpora instead of writing MIDI files")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (defaults to the number of CPUs)")
+    args = parser.parse_args()
+    extract_tracks(args.dataset_dir, args.melody_dir, args.accompaniment_dir, args.tokenize, args.workers)
@@ -0,0 +1,341 @@
+import os
+import csv
+import json
+import importlib
+from functools import lru_cache
+from glob import glob
+import numpy as np
+import torch
+from torch.utils.data import Dataset, get_worker_info
+from tqdm import tqdm
+
+# Files that make up a packed corpus directory
+TOKENS_FILE = "tokens.bin" # Every song's token ids back to back in one contiguous array
+OFFSETS_FILE = "offsets.npy" # Where each song starts in tokens.bin (in tokens)
+LENGTHS_FILE = "lengths.npy" # How many tokens each song has
+METADATA_FILE = "metadata.csv" # One row per song: song_id, source, num_tokens
+INFO_FILE = "corpus.json" # dtype, totals and the tokenizer's BOS/EOS ids
+DEDUP_MANIFEST_FILE = "dedup_manifest.csv" # Written by dedup_corpus.py: one row per song with its status ("kept", or why it was dropped)
+
+@lru_cache(maxsize=None)
+def tokenizer_special_ids():
+    """BOS and EOS ids in MidiTokenizer's vocabulary, worked out once per process"""
+    # This file is imported both as part of the AI_TRAINING package and directly by the scripts in its folder
+    tokenizer_class = importlib.import_module(f"{__package__}.tokenizer_class" if __package__ else "tokenizer_class")
+    vocab = tokenizer_class.MidiTokenizer().tokenizer.vocab
+    return {"bos_id": vocab["BOS_None"], "eos_id": vocab["EOS_None"]}
+
+class PackedCorpusWriter:
+    """
+    Writes songs into a packed corpus directory, one song at a time.
+    mode: "w" starts a new corpus, "a" appends to an existing one (tokens written after the last saved index are discarded)
+    special_ids: {"bos_id", "eos_id"} of the tokenizer the songs were tokenized with, recorded in corpus.json for packing (defaults to MidiTokenizer's)
+    """
+    def __init__(self, corpus_dir, dtype = np.int16, mode = "w", special_ids = None):
+        self.corpus_dir = corpus_dir
+        self.dtype = np.dtype(dtype)
+        self.special_ids = dict(special_ids) if special_ids is not None else None
+        os.makedirs(corpus_dir, exist_ok=True)
+        tokens_path = os.path.join(corpus_dir, TOKENS_FILE)
+
+        self.offsets, self.lengths, self.sources = [], [], []
+        if mode == "a" and os.path.exists(os.path.join(corpus_dir, INFO_FILE)):
+            existing = PackedCorpus(corpus_dir)
+            self.dtype = existing.tokens.dtype
+            self.offsets = existing.offsets.tolist()
+            self.lengths = existing.lengths.tolist()
+            self.sources = existing.sources()
+            if self.special_ids is None and "bos_id" in existing.info:
+                self.special_ids = {"bos_id": existing.info["bos_id"], "eos_id": existing.info["eos_id"]}
+            del existing # Release the memmap before the file is reopened for writing
+            self.num_tokens = self.offsets[-1] + self.lengths[-1] if self.offsets else 0
+            self._file = open(tokens_path, "r+b")
+            self._file.truncate(self.num_tokens * self.dtype.itemsize) # Drop anything written after the last close()
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self.num_tokens = 0
+            self._file = open(tokens_path, "wb")
+        if self.special_ids is None:
+            self.special_ids = tokenizer_special_ids()
+
+    def add(self, token_ids, source = ""):
+        """Append one song's tokens, returning its song id"""
+        tokens = np.asarray(token_ids, dtype=self.dtype)
+        self._file.write(tokens.tobytes())
+        self.offsets.append(self.num_tokens)
+        self.lengths.append(len(tokens))
+        self.sources.append(str(source))
+        self.num_tokens += len(tokens)
+        return len(self.offsets) - 1
+
+    def flush(self):
+        """Write the index so that everything added so far survives a crash"""
+        self._file.flush()
+        np.save(os.path.join(self.corpus_dir, OFFSETS_FILE), np.asarray(self.offsets, dtype=np.int64))
+        np.save(os.path.join(self.corpus_dir, LENGTHS_FILE), np.asarray(self.lengths, dtype=np.int64))
+        with open(os.path.join(self.corpus_dir, METADATA_FILE), "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["song_id", "source", "num_tokens"])
+            writer.writerows(zip(range(len(self.offsets)), self.sources, self.lengths))
+        with open(os.path.join(self.corpus_dir, INFO_FILE), "w") as f:
+            json.dump({"dtype": self.dtype.name, "num_songs": len(self.offsets), "num_tokens": self.num_tokens, **self.special_ids}, f, indent=2)
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class PackedCorpus:
+    """Read-only view of a packed corpus directory. Songs and windows are slices of one memory-mapped array, so reading them copies nothing"""
+    def __init__(self, corpus_dir):
+        self.corpus_dir = corpus_dir
+        with open(os.path.join(corpus_dir, INFO_FILE)) as f:
+            self.info = json.load(f)
+        self.offsets = np.load(os.path.join(corpus_dir, OFFSETS_FILE))
+        self.lengths = np.load(os.path.join(corpus_dir, LENGTHS_FILE))
+        num_tokens = self.info["num_tokens"]
+        # np.memmap can't map an empty file
+        self.tokens = np.memmap(os.path.join(corpus_dir, TOKENS_FILE), dtype=self.info["dtype"], mode="r", shape=(num_tokens,)) if num_tokens else np.zeros(0, dtype=self.info["dtype"])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def song(self, song_id):
+        """All tokens of one song (a view into the memmap)"""
+        offset = self.offsets[song_id]
+        return self.tokens[offset:offset + self.lengths[song_id]]
+
+    def window(self, song_id, start, length):
+        """length tokens of a song starting at start (a view into the memmap)"""
+        offset = self.offsets[song_id] + start
+        return self.tokens[offset:offset + length]
+
+    def special_ids(self):
+        """{"bos_id", "eos_id"} recorded when the corpus was written (MidiTokenizer's for corpora written before they were recorded)"""
+        if "bos_id" in self.info:
+            return {"bos_id": self.info["bos_id"], "eos_id": self.info["eos_id"]}
+        return tokenizer_special_ids()
+
+    def sources(self):
+        """Source path of every song, read from the metadata table"""
+        with open(os.path.join(self.corpus_dir, METADATA_FILE), newline="", encoding="utf-8") as f:
+            return [row["source"] for row in csv.DictReader(f)]
+
+def kept_songs(manifest_path):
+    """Rows of a dedup manifest (see dedup_corpus.py) for the songs that were kept"""
+    with open(manifest_path, newline="", encoding="utf-8") as f:
+        return [row for row in csv.DictReader(f) if row["status"] == "kept"]
+
+def convert_npy_dir(npy_dir, corpus_dir):
+    """Pack a directory of per-song .npy token files (as written by tokenize_dataset.py) into a packed corpus"""
+    paths = sorted(glob(os.path.join(npy_dir, "**", "*.npy"), recursive=True))
+    with PackedCorpusWriter(corpus_dir) as writer:
+        for path in tqdm(paths, desc="Packing token files", unit="file"):
+            tokens = np.load(path)
+            if len(tokens) == 0:
+                continue
+            writer.add(tokens, source=os.path.relpath(path, npy_dir))
+    print(f"Packed {len(writer.offsets)} songs ({writer.num_tokens} tokens) into {corpus_dir}")
+    return corpus_dir
+
+class PackedBatch:
+    """
+    A whole batch from __getitems__: inputs and targets [B, seq_length]. Unpacks like (inputs, targets), but can't be indexed, so a DataLoader
+    left on default_collate fails straight away instead of stacking inputs and targets into one [2, B, seq_length] tensor
+    """
+    __slots__ = ("inputs", "targets")
+
+    def __init__(self, inputs, targets):
+        self.inputs = inputs
+        self.targets = targets
+
+    def __iter__(self):
+        return iter((self.inputs, self.targets))
+
+    def __getitem__(self, index):
+        raise TypeError("A packed dataset returns whole batches from __getitems__: create the DataLoader with collate_fn=collate_batch")
+
+def collate_batch(batch):
+    """collate_fn for a DataLoader over a packed dataset: __getitems__ already returns the whole batch, so there is nothing to stack"""
+    inputs, targets = batch
+    return inputs, targets
+
+class _PackedDataset(Dataset):
+    """
+    What the packed corpus datasets share: the corpus, epochs that only depend on (seed, epoch) so every DataLoader worker agrees on them,
+    and batches assembled in one int64 buffer (page-locked in the main process when pin_memory is set)
+    """
+    def __init__(self, corpus, seq_length, mode, seed, pin_memory):
+        self.corpus = corpus if isinstance(corpus, PackedCorpus) else PackedCorpus(corpus)
+        self.seq_length = seq_length
+        self.mode = mode
+        self.seed = seed
+        self.epoch = 0
+        self._next_epoch = 0
+        self._cache_epoch = None
+        self._cache = None
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self._positions = np.arange(seq_length + 1) # Offsets of the tokens within a window (input plus the target shifted by one)
+
+    def set_epoch(self, epoch = None):
+        """Move to an epoch (the next one if epoch is None, pass it explicitly when resuming from a checkpoint)"""
+        self.epoch = self._next_epoch if epoch is None else epoch
+        self._next_epoch = self.epoch + 1
+        self._cache_epoch = None
+        self._cache = None
+
+    set_epoch_files = set_epoch # Same name as MIDIDatasetNPY, so a training loop can use either dataset
+
+    def _per_epoch(self, build):
+        """build() for the current epoch, worked out once per epoch in each process"""
+        if self._cache_epoch != self.epoch:
+            self._cache = build()
+            self._cache_epoch = self.epoch
+        return self._cache
+
+    def _to_batch(self, windows):
+        """Token windows [B, seq_length + 1] as one int64 tensor. Workers hand tensors over through shared memory, so only the main process pins"""
+        pin = self.pin_memory and get_worker_info() is None
+        batch = torch.empty(windows.shape, dtype=torch.long, pin_memory=pin)
+        batch.copy_(torch.from_numpy(windows)) # Widens to int64 while copying
+        return batch
+
+class PackedMIDIDataset(_PackedDataset):
+    """
+    Same samples as MIDIDatasetNPY, but read from a packed corpus: every window is a slice of one memory-mapped array, no file is opened per sample.
+    A DataLoader fetches each batch with one call to __getitems__ (pass collate_fn=collate_batch), which gathers all B windows in one indexing operation.
+    corpus: A PackedCorpus or the path of a packed corpus directory
+    seed: Training windows only depend on (seed, epoch), as in MIDIDatasetNPY
+    pin_memory: Gather batches into page-locked memory for faster copies to the GPU (only in the main process, workers hand tensors over through shared memory)
+    manifest: Dedup manifest of the corpus, only the songs it kept are used
+    """
+    def __init__(self, corpus, seq_length=64, mode = "train", samples_per_epoch = 50000, seed = 0, pin_memory = None, manifest = None):
+        super().__init__(corpus, seq_length, mode, seed, pin_memory)
+        self.samples_per_epoch = samples_per_epoch
+
+        # Windows need seq_length + 1 tokens (input plus the target shifted by one)
+        self.window_counts = np.maximum(self.corpus.lengths - seq_length, 0)
+        if manifest is not None:
+            kept = np.zeros(len(self.corpus), dtype=bool)
+            kept[[int(row["song_id"]) for row in kept_songs(manifest)]] = True
+            self.window_counts[~kept] = 0 # Dropped songs get no windows
+        self.eligible_songs = np.flatnonzero(self.window_counts > 0) # Songs that are too short are never picked, so there is no retry loop
+        if mode == "train" and len(self.eligible_songs) == 0:
+            raise ValueError(f"No song {'kept by the manifest' if manifest is not None else 'in the corpus'} has more than seq_length={seq_length} tokens, so there are no training windows")
+        if mode in ["val", "test"]:
+            self.cumulative_counts = np.concatenate([[0], np.cumsum(self.window_counts)])
+            self.total_sequences = int(self.cumulative_counts[-1])
+
+    def __len__(self):
+        if self.mode == "train":
+            return self.samples_per_epoch
+        else:
+            return self.total_sequences
+
+    def _window_plan(self):
+        """Position in the corpus of every training window this epoch, the same in every worker process"""
+        return self._per_epoch(self._build_window_plan)
+
+    def _build_window_plan(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        song_ids = self.eligible_songs[rng.integers(len(self.eligible_songs), size=self.samples_per_epoch)]
+        return self.corpus.offsets[song_ids] + rng.integers(0, self.window_counts[song_ids])
+
+    def _window_starts(self, indices):
+        """Position in the corpus of the window for each index"""
+        indices = np.asarray(indices, dtype=np.int64)
+        if self.mode == "train":
+            return self._window_plan()[indices]
+        song_ids = np.searchsorted(self.cumulative_counts, indices, side='right') - 1
+        return self.corpus.offsets[song_ids] + indices - self.cumulative_counts[song_ids]
+
+    def __getitem__(self, idx):
+        start = self._window_starts([idx])[0]
+        window = self.corpus.tokens[start:start + self.seq_length + 1] # Zero-copy view of input + 1 token
+        window = torch.from_numpy(window.astype(np.int64)) # The only copy, straight into the dtype the model needs
+        return window[:-1], window[1:]
+
+    def __getitems__(self, indices):
+        """
+        A whole batch at once (a PackedBatch): input and target [B, seq_length] as views of one int64 buffer, shifted by one token.
+        The views aren't contiguous, so flatten targets with .reshape(-1) rather than .view(-1)
+        """
+        starts = self._window_starts(indices)
+        batch = self._to_batch(self.corpus.tokens[starts[:, None] + self._positions]) # One gather of every window from the memmap: [B, seq_length + 1]
+        return PackedBatch(batch[:, :-1], batch[:, 1:])
+
+IGNORE_INDEX = -100 # Targets nn.CrossEntropyLoss skips by default
+
+class PackedSongsDataset(_PackedDataset):
+    """
+    Every song wrapped in BOS ... EOS and concatenated into one stream, cut into windows of seq_length + 1 tokens that follow on from each other.
+    No song is too short to be used, and each epoch covers every token of the stream once. Batches are gathered with __getitems__ (collate_fn=collate_batch).
+    corpus: A PackedCorpus or the path of a packed corpus directory
+    samples_per_epoch: Cap on windows per training epoch (None uses them all)
+    seed: Training song and window order only depend on (seed, epoch)
+    mask_boundaries: Set the target after each EOS (the next song's BOS) to IGNORE_INDEX, so the loss never asks the model to continue across songs
+    bos_id, eos_id: Token ids to wrap songs in (default to the ones recorded in the corpus, i.e. the tokenizer's BOS_None and EOS_None)
+    manifest: Dedup manifest of the corpus, only the songs it kept are packed
+    """
+    def __init__(self, corpus, seq_length=64, mode = "train", samples_per_epoch = None, seed = 0, mask_boundaries = False, bos_id = None, eos_id = None, pin_memory = None, manifest = None):
+        super().__init__(corpus, seq_length, mode, seed, pin_memory)
+        self.mask_boundaries = mask_boundaries
+        special_ids = self.corpus.special_ids() if bos_id is None or eos_id is None else {}
+        self.bos_id = bos_id if bos_id is not None else special_ids["bos_id"]
+        self.eos_id = eos_id if eos_id is not None else special_ids["eos_id"]
+
+        self.song_ids = np.sort([int(row["song_id"]) for row in kept_songs(manifest)]).astype(np.int64) if manifest is not None else np.arange(len(self.corpus))
+        self.stream_lengths = self.corpus.lengths + 2 # Each song plus its BOS and EOS
+        self.num_windows = max(int(self.stream_lengths[self.song_ids].sum()) - 1, 0) // seq_length # Windows start every seq_length tokens and need one extra for the target
+        self.samples_per_epoch = self.num_windows if samples_per_epoch is None or mode != "train" else min(samples_per_epoch, self.num_windows)
+
+    def __len__(self):
+        return self.samples_per_epoch
+
+    def _stream_layout(self):
+        """Song order, where each song starts in the stream and the order windows are visited in, for this epoch"""
+        return self._per_epoch(self._build_stream_layout)
+
+    def _build_stream_layout(self):
+        if self.mode == "train":
+            rng = np.random.default_rng([self.seed, self.epoch])
+            song_order = rng.permutation(self.song_ids)
+            window_order = rng.permutation(self.num_windows)
+        else:
+            song_order = self.song_ids
+            window_order = np.arange(self.num_windows)
+        song_starts = np.concatenate([[0], np.cumsum(self.stream_lengths[song_order])[:-1]])
+        return song_order, song_starts, window_order
+
+    def _gather(self, indices):
+        """Windows for some indices: token ids [B, seq_length + 1], with each token's position in its song (0 is BOS) and that song's length"""
+        song_order, song_starts, window_order = self._stream_layout()
+        positions = window_order[np.asarray(indices, dtype=np.int64)][:, None] * self.seq_length + self._positions
+        slots = np.searchsorted(song_starts, positions, side='right') - 1
+        song_ids = song_order[slots]
+        local = positions - song_starts[slots]
+        lengths = self.corpus.lengths[song_ids]
+        body = np.clip(local - 1, 0, np.maximum(lengths - 1, 0)) # BOS/EOS positions read a harmless in-song token that is then replaced
+        windows = self.corpus.tokens[self.corpus.offsets[song_ids] + body].astype(np.int64) # One gather for the whole batch
+        windows[local == 0] = self.bos_id
+        windows[local == lengths + 1] = self.eos_id
+        return windows, local, lengths
+
+    def __getitems__(self, indices):
+        """A whole batch at once (a PackedBatch): input and target [B, seq_length], shifted by one token"""
+        windows, local, lengths = self._gather(indices)
+        batch = self._to_batch(windows)
+        inputs, targets = batch[:, :-1], batch[:, 1:]
+        if self.mask_boundaries:
+            targets = targets.clone()
+            targets[torch.from_numpy(local[:, :-1] == lengths[:, :-1] + 1)] = IGNORE_INDEX # Input is an EOS, so the target starts the next song
+        return PackedBatch(inputs, targets)
+
+    def __getitem__(self, idx):
+        inputs, targets = self.__getitems__([idx])
+        return inputs[0], targets[0]
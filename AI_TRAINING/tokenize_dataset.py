@@ -1,31 +1,155 @@
 import os
+import re
+import sys
+import json
+import hashlib
+import argparse
 import numpy as np
 from glob import glob
+from multiprocessing import Pool
 from tqdm import tqdm
 from tokenizer_class import MidiTokenizer
-from pathlib import Path
+from packed_corpus import PackedCorpusWriter
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # This script runs from its own folder, the SHARED package is in the repo root
+from SHARED import PoolRun
 
 dataset_dir = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\MIDI_DATASET_MELODY"
 save_dir = r"C:\tempp\MELODY_TOKENS"
+save_format = "packed" # "packed" writes one memory-mapped corpus (see packed_corpus.py), "npy" writes one .npy file per song
 
-os.makedirs(save_dir, exist_ok=True)
+MANIFEST_FILE = "tokenize_manifest.jsonl" # One line per finished input, used to resume after a crash
+STATS_FILE = "tokenize_stats.json"
+FLUSH_EVERY = 500 # Files between checkpoints of the packed index and the manifest
 
-tokenizer = MidiTokenizer()
+_tokenizer = None # One tokenizer per worker process
 
-midi_paths = glob(f"{dataset_dir}/**/*.mid", recursive=True)
+def _init_worker():
+    global _tokenizer
+    _tokenizer = MidiTokenizer()
 
-for index, path in enumerate(tqdm(midi_paths, desc="Tokenizing MIDI files")):
+def file_fingerprint(path):
+    """Size, modification time and content hash of an input, so a finished file is only skipped if it hasn't changed"""
+    stat = os.stat(path)
+    with open(path, "rb") as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha1": sha1}
+
+def output_key(relative_path):
+    """Collision-free output name: the relative path flattened into one name, plus a short hash of the path (so a/b_c.mid and a_b/c.mid still differ)"""
+    stem = os.path.splitext(relative_path)[0]
+    flattened = re.sub(r"[^A-Za-z0-9_.-]+", "_", stem.replace(os.sep, "__").replace("/", "__"))
+    path_hash = hashlib.sha1(relative_path.replace(os.sep, "/").encode("utf-8")).hexdigest()[:8]
+    return f"{flattened}_{path_hash}"
+
+def tokenize_file(task):
+    """Tokenize one MIDI file in a worker, returning the tokens or the error that stopped it"""
+    path, relative_path = task
+    result = {"path": relative_path, "key": output_key(relative_path)}
     try:
-        tokens = tokenizer.tokenize_midi_file(path)
+        result.update(file_fingerprint(path))
+        tokens = _tokenizer.tokenize_midi_file(path)
         token_ids = tokens[0].ids if isinstance(tokens, list) else tokens.ids
+        result["token_ids"] = np.array(token_ids, dtype=np.int16) # Small + efficient, also cheaper to send back to the main process
+    except Exception as e:
+        result["error"] = type(e).__name__
+        result["message"] = str(e)
+    return result
 
-        if len(token_ids) == 0:
-            continue
+def load_manifest(manifest_path):
+    """Finished inputs from previous runs, by relative path"""
+    finished = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError: # A line cut short by a crash
+                    continue
+                finished[record["path"]] = record
+    return finished
 
-        # Save each song’s tokens as .npy
-        og_path = Path(path)
-        save_path = os.path.join(save_dir, f"{og_path.stem}.npy")
-        np.save(save_path, np.array(token_ids, dtype=np.int16))  # Small + efficient
+def is_finished(path, record):
+    """True if the file was already tokenized and hasn't changed since (the hash is only checked when size or mtime differ)"""
+    if record is None:
+        return False
+    stat = os.stat(path)
+    if stat.st_size == record["size"] and stat.st_mtime == record["mtime"]:
+        return True
+    return stat.st_size == record["size"] and file_fingerprint(path)["sha1"] == record["sha1"]
 
-    except Exception as e:
-        print(f"Skipping {os.path.basename(path)} due to error: {e}")
\ No newline at end of file
+def tokenize_dataset(dataset_dir, save_dir, save_format = "packed", num_workers = None):
+    os.makedirs(save_dir, exist_ok=True)
+    manifest_path = os.path.join(save_dir, MANIFEST_FILE)
+    finished = load_manifest(manifest_path)
+
+    midi_paths = glob(f"{dataset_dir}/**/*.mid", recursive=True)
+    tasks = []
+    changed = [] # Finished inputs that have changed since they were tokenized
+    for path in midi_paths:
+        relative_path = os.path.relpath(path, dataset_dir)
+        record = finished.get(relative_path)
+        if not is_finished(path, record):
+            tasks.append((path, relative_path))
+            if record is not None:
+                changed.append(relative_path)
+    if changed and save_format == "packed":
+        # A .npy output is simply overwritten, but a packed corpus can only be appended to: the old tokens would stay in it as a second copy of the song
+        raise ValueError(f"{len(changed)} files have changed since they were tokenized ({', '.join(sorted(changed)[:5])}{', ...' if len(changed) > 5 else ''}) and "
+                         f"their old tokens can't be removed from the packed corpus in {save_dir}: tokenize into a new save directory instead")
+    print(f"{len(midi_paths) - len(tasks)} of {len(midi_paths)} files already tokenized, {len(tasks)} to go")
+
+    packed_writer = PackedCorpusWriter(save_dir, mode="a") if save_format == "packed" else None
+    pending_records = [] # Manifest lines are only written once the outputs they describe are safely on disk
+    run = PoolRun()
+    tokens_done = 0
+
+    def checkpoint():
+        if packed_writer is not None:
+            packed_writer.flush()
+        manifest_file.writelines(json.dumps(record) + "\n" for record in pending_records)
+        manifest_file.flush()
+        pending_records.clear()
+
+    with Pool(num_workers, initializer=_init_worker) as pool, open(manifest_path, "a", encoding="utf-8") as manifest_file:
+        for result in tqdm(pool.imap_unordered(tokenize_file, tasks, chunksize=8), total=len(tasks), desc="Tokenizing MIDI files"):
+            if not run.record(result):
+                continue
+
+            token_ids = result.pop("token_ids")
+            result["num_tokens"] = len(token_ids)
+            if len(token_ids) > 0:
+                if packed_writer is not None:
+                    packed_writer.add(token_ids, source=result["path"])
+                else:
+                    np.save(os.path.join(save_dir, f"{result['key']}.npy"), token_ids)
+            tokens_done += len(token_ids)
+            pending_records.append(result)
+            if len(pending_records) >= FLUSH_EVERY:
+                checkpoint()
+        checkpoint()
+    if packed_writer is not None:
+        packed_writer.close()
+
+    run.finish()
+    stats = {
+        "files": run.done,
+        "tokens": tokens_done,
+        "seconds": run.seconds,
+        "files_per_second": run.rate(run.done),
+        "tokens_per_second": run.rate(tokens_done),
+        "skipped_already_done": len(midi_paths) - len(tasks),
+        "failures": dict(run.failures),
+    }
+    with open(os.path.join(save_dir, STATS_FILE), "w") as f:
+        json.dump(stats, f, indent=2)
+    run.report(f"Tokenized {run.done} files ({tokens_done} tokens)", f", {stats['tokens_per_second']:.0f} tokens/s")
+    return stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tokenize a MIDI dataset across a process pool, resuming from the manifest of finished files")
+    parser.add_argument("--dataset-dir", default=dataset_dir)
+    parser.add_argument("--save-dir", default=save_dir)
+    parser.add_argument("--format", default=save_format, choices=["packed", "npy"])
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (defaults to the number of CPUs)")
+    args = parser.parse_args()
+    tokenize_dataset(args.dataset_dir, args.save_dir, args.format, args.workers)
@@ -2,7 +2,7 @@ from miditok import REMI, TokenizerConfig, TokSequence
 from pathlib import Path
 from music21 import stream, converter
 import os
-from typing import cast
+from typing import cast, Iterable
 
 class MidiTokenizer:
     def __init__(self, config: dict | None = None):
@@ -28,9 +28,8 @@ class MidiTokenizer:
         """Tokenize a MIDI file into tokens."""
         return self.tokenizer(Path(input_path))
 
-    def token_ids_to_midi(self, token_ids: list[int | list[int]], output_dir=r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\files\generated_midi_files"):
-        """Convert token IDs to a MIDI file and save it."""
-        self.midi_paths = []
+    def _decode_ids(self, token_ids: list[int]):
+        """Decode token IDs into a symusic Score."""
         #Convert token IDs back into tokens (strings)
         token_str = self.tokenizer._ids_to_tokens(token_ids)
 
@@ -41,7 +40,12 @@ class MidiTokenizer:
         )
 
         #Decode into Score
-        score = self.tokenizer.decode([token_seq])
+        return self.tokenizer.decode([token_seq])
+
+    def token_ids_to_midi(self, token_ids: list[int | list[int]], output_dir=r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\files\generated_midi_files"):
+        """Convert token IDs to a MIDI file and save it."""
+        self.midi_paths = []
+        score = self._decode_ids(token_ids)
 
         #Export the decoded MIDI
         os.makedirs(output_dir, exist_ok=True)
@@ -51,6 +55,30 @@ class MidiTokenizer:
         self.midi_paths.append(output_file_path)
         return self.midi_paths
 
+    def stream_bars_to_midi(self, token_ids: Iterable[int], output_dir=r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\files\generated_midi_files\bars"):
+        """Decode a stream of token IDs bar by bar, yielding (bar index, MIDI path) as soon as each bar is closed by the next Bar token."""
+        bar_token_id = self.tokenizer.vocab["Bar_None"]
+        os.makedirs(output_dir, exist_ok=True)
+        bar_tokens = []
+        bar_index = 0
+
+        def dump_bar(tokens, index):
+            output_file_path = os.path.join(output_dir, f"decoded_bar_{index:04d}.mid")
+            self._decode_ids(tokens).dump_midi(Path(output_file_path))
+            return output_file_path
+
+        for token_id in token_ids:
+            # A new Bar token means that everything buffered so far is a complete bar
+            if token_id == bar_token_id and bar_token_id in bar_tokens:
+                yield bar_index, dump_bar(bar_tokens, bar_index)
+                bar_index += 1
+                bar_tokens = []
+            bar_tokens.append(token_id)
+
+        # Whatever is left when the stream ends is the final (possibly unfinished) bar
+        if bar_tokens:
+            yield bar_index, dump_bar(bar_tokens, bar_index)
+
     def merge_midi_paths(self, output_dir=r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\files\generated_midi_files"):
         """Merge multiple MIDI files into one."""
         merged_score = stream.Score()
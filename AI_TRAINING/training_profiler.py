@@ -0,0 +1,188 @@
+import os
+import csv
+import json
+import time
+from contextlib import nullcontext
+import numpy as np
+import psutil
+import torch
+
+PHASES = ("data", "copy", "forward", "backward", "optimizer") # DataLoader wait, host→device copy, forward pass, backward pass, optimizer step
+TRACE_FIELDS = ["step", *PHASES, "other", "step_seconds", "tokens", "tokens_per_second", "rss_mb", "peak_rss_mb", "cuda_peak_mb"]
+
+_DISABLED = nullcontext() # Reused for every phase when profiling is off, so a disabled phase costs one call
+
+class _Phase:
+    """Times one phase of a step, waiting for queued GPU work at both ends so asynchronous kernels are counted in the phase that launched them"""
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.profiler._synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._synchronize()
+        self.profiler._current[self.name] += time.perf_counter() - self.start
+
+class TrainingProfiler:
+    """
+    Per-step timings of a training loop: DataLoader wait, host→device copy, forward, backward and optimizer step, plus tokens/sec and peak RSS.
+    Every step is written to a trace (CSV or JSONL, chosen by the file extension) and a summary table is printed every summary_every steps.
+    When enabled is False every call returns straight away, so the instrumentation can stay in the training loop.
+
+        profiler = TrainingProfiler(enabled=True, trace_path="train_trace.csv", device=device)
+        for batch_x, batch_y in profiler.iter_loader(train_loader):
+            with profiler.phase("copy"):
+                x, y = batch_x.to(device), batch_y.to(device)
+            with profiler.phase("forward"):
+                loss = criterion(model(x).view(-1, vocab_size), y.reshape(-1))
+            with profiler.phase("backward"):
+                loss.backward()
+            with profiler.phase("optimizer"):
+                optimizer.step()
+            profiler.end_step(num_tokens=y.numel())
+        profiler.close()
+
+    synchronize: Wait for the GPU at phase boundaries (accurate CUDA timings, at a small cost to throughput)
+    """
+    def __init__(self, enabled = True, trace_path = None, summary_every = 100, device = None, synchronize = True):
+        self.enabled = enabled
+        self.summary_every = summary_every
+        device = torch.device(device) if device is not None else torch.device("cpu")
+        self.cuda = enabled and device.type == "cuda" and torch.cuda.is_available()
+        self.synchronize = synchronize and self.cuda
+        self.step = 0
+        self.peak_rss = 0
+        self._phases = {name: _Phase(self, name) for name in PHASES}
+        self._current = dict.fromkeys(PHASES, 0.0)
+        self._history = np.zeros((1024, len(TRACE_FIELDS))) # One row per step (columns TRACE_FIELDS), grown as needed, for the summaries
+        self._window_start = 0 # First step since the last summary
+        self._trace_file = None
+        self._trace_writer = None
+        if not enabled:
+            return
+
+        self._process = psutil.Process()
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(device)
+        if trace_path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(trace_path)), exist_ok=True)
+            self._trace_file = open(trace_path, "w", newline="")
+            if trace_path.endswith(".csv"):
+                self._trace_writer = csv.DictWriter(self._trace_file, fieldnames=TRACE_FIELDS)
+                self._trace_writer.writeheader()
+        self._last_step_end = time.perf_counter()
+
+    def _synchronize(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def phase(self, name):
+        """Context manager timing one of PHASES for the current step"""
+        if not self.enabled:
+            return _DISABLED
+        return self._phases[name]
+
+    def iter_loader(self, loader):
+        """Iterate a DataLoader, timing how long each batch takes to arrive as the "data" phase"""
+        if not self.enabled:
+            return iter(loader)
+        return self._timed_batches(loader)
+
+    def _timed_batches(self, loader):
+        iterator = iter(loader)
+        while True:
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self._current["data"] += time.perf_counter() - start
+            yield batch
+
+    def end_step(self, num_tokens = 0):
+        """Close the current step: record it, write it to the trace and print a summary every summary_every steps"""
+        if not self.enabled:
+            return
+        self._synchronize()
+        now = time.perf_counter()
+        step_seconds = now - self._last_step_end
+        self._last_step_end = now
+        rss = self._process.memory_info().rss
+        self.peak_rss = max(self.peak_rss, rss)
+
+        row = {"step": self.step, **self._current}
+        row["other"] = max(step_seconds - sum(self._current.values()), 0.0) # Everything outside the timed phases (zero_grad, loss.item(), logging...)
+        row["step_seconds"] = step_seconds
+        row["tokens"] = num_tokens
+        row["tokens_per_second"] = num_tokens / step_seconds if step_seconds > 0 else 0.0
+        row["rss_mb"] = rss / 2 ** 20
+        row["peak_rss_mb"] = self.peak_rss / 2 ** 20
+        row["cuda_peak_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20 if self.cuda else 0.0
+        if self.step == len(self._history):
+            self._history = np.concatenate([self._history, np.zeros_like(self._history)])
+        self._history[self.step] = [row[field] for field in TRACE_FIELDS]
+        self._current = dict.fromkeys(PHASES, 0.0)
+        self.step += 1
+
+        if self._trace_writer is not None:
+            self._trace_writer.writerow(row)
+        elif self._trace_file is not None:
+            self._trace_file.write(json.dumps(row) + "\n")
+
+        if self.summary_every and self.step % self.summary_every == 0:
+            self.print_summary(self._window_start, f"Steps {self._window_start}-{self.step - 1}")
+            self._window_start = self.step
+            if self._trace_file is not None:
+                self._trace_file.flush()
+
+    def summarize(self, first_step = 0):
+        """Mean, median and 95th percentile of each phase from first_step on, with each phase's share of the step time"""
+        rows = self._history[first_step:self.step]
+        columns = {field: rows[:, i] for i, field in enumerate(TRACE_FIELDS)}
+        total_seconds = columns["step_seconds"].sum()
+        summary = {}
+        for name in (*PHASES, "other", "step_seconds"):
+            values = columns[name]
+            summary[name] = {
+                "mean_ms": values.mean() * 1000,
+                "p50_ms": np.percentile(values, 50) * 1000,
+                "p95_ms": np.percentile(values, 95) * 1000,
+                "share": values.sum() / total_seconds if total_seconds > 0 else 0.0,
+            }
+        summary["tokens_per_second"] = columns["tokens"].sum() / total_seconds if total_seconds > 0 else 0.0
+        summary["peak_rss_mb"] = columns["peak_rss_mb"].max()
+        summary["cuda_peak_mb"] = columns["cuda_peak_mb"].max()
+        return summary
+
+    def print_summary(self, first_step = 0, title = "All steps"):
+        if first_step >= self.step:
+            return None
+        summary = self.summarize(first_step)
+        print(f"{title}: {summary['tokens_per_second']:.0f} tokens/sec, peak RSS {summary['peak_rss_mb']:.0f} MB" + (f", CUDA peak {summary['cuda_peak_mb']:.0f} MB" if self.cuda else ""))
+        print(f"  {'phase':<12}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'share':>8}")
+        for name in (*PHASES, "other", "step_seconds"):
+            stats = summary[name]
+            label = "step" if name == "step_seconds" else name
+            print(f"  {label:<12}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['share'] * 100:>7.1f}%")
+        return summary
+
+    def close(self):
+        """Print the summary over every step and close the trace"""
+        if not self.enabled:
+            return None
+        summary = self.print_summary()
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+        return summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,149 @@
+import os
+import io
+import json
+import hashlib
+import argparse
+from glob import glob
+from pathlib import Path
+from contextlib import redirect_stdout
+from multiprocessing import Pool
+from tqdm import tqdm
+from SHARED import PoolRun
+from .postprocess_midi import MidiPostProcessor, KEY_PROFILES
+
+CONFIG_FILE = "postprocess_config.json" # Settings the outputs in a folder were made with, and their hash
+
+_config = None # Settings of the run, set once per worker process
+
+def _init_worker(config):
+    global _config
+    _config = config
+
+def config_hash(config):
+    """Hash of the postprocessing settings, independent of key order"""
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()
+
+def write_config(output_dir, config):
+    """
+    Record the settings in the output folder, rewriting the file only when they changed: its modification time is then when the settings
+    last changed, so any output older than it is stale. Returns the path of the file and whether the settings changed
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    config_path = os.path.join(output_dir, CONFIG_FILE)
+    new_hash = config_hash(config)
+    if os.path.exists(config_path):
+        with open(config_path, encoding="utf-8") as f:
+            if json.load(f).get("hash") == new_hash:
+                return config_path, False
+    temporary_path = config_path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as f:
+        json.dump({"hash": new_hash, "config": config}, f, indent=2, sort_keys=True)
+    os.replace(temporary_path, config_path) # Atomic, so an interrupted run never leaves half a file
+    return config_path, True
+
+def list_inputs(source):
+    """
+    (path, path relative to the source) of every MIDI file under a directory, or listed in a manifest (a text file with one MIDI path per line,
+    relative paths being relative to the manifest's folder; blank lines and lines starting with # are ignored)
+    """
+    if os.path.isdir(source):
+        paths = sorted(glob(os.path.join(source, "**", "*.mid"), recursive=True) + glob(os.path.join(source, "**", "*.midi"), recursive=True))
+        return [(path, os.path.relpath(path, source)) for path in paths]
+    base_dir = os.path.dirname(os.path.abspath(source))
+    inputs = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            path = os.path.normpath(os.path.join(base_dir, line))
+            relative_path = os.path.relpath(path, base_dir)
+            inputs.append((path, relative_path if not relative_path.startswith("..") else os.path.basename(path))) # Files outside the manifest's folder go straight into the output folder
+    return inputs
+
+def output_path_for(relative_path, output_dir, drums):
+    """Where the postprocessed version of a file goes, named like postprocess_midi / main.py name them and keeping the folder structure"""
+    relative = Path(relative_path)
+    suffix = "_postprocessed_with_drums" if drums else "_postprocessed"
+    return str(Path(output_dir) / relative.parent / f"{relative.stem}{suffix}.mid")
+
+def is_up_to_date(input_path, output_path, config_path):
+    """An output can be skipped if it is newer than both its input and the current settings"""
+    if not os.path.exists(output_path):
+        return False
+    output_time = os.path.getmtime(output_path)
+    return output_time > os.path.getmtime(input_path) and output_time > os.path.getmtime(config_path)
+
+def process_file(task):
+    """Postprocess one file (and add drums if asked) in memory and write the result, in a worker"""
+    input_path, output_path = task
+    result = {"path": input_path}
+    try:
+        processor = MidiPostProcessor(**_config["processor"]) # A new one per file: process() overwrites the key with the detected one, which must not carry over to the next file
+        with redirect_stdout(io.StringIO()): # The postprocessor prints the key of every file
+            midi = processor.process(input_path)
+            if _config["drums"]:
+                midi = processor.add_drum_track(midi, _config["beat_length"])
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        midi.write(output_path)
+    except Exception as e:
+        result["error"] = type(e).__name__
+        result["message"] = str(e)
+    return result
+
+def batch_postprocess(source, output_dir, processor_settings = None, drums = False, beat_length = 0.25, num_workers = None, force = False):
+    """
+    Postprocess every MIDI file in a directory or manifest across a pool of worker processes, writing them to output_dir.
+    Outputs newer than both their input and the settings (see write_config) are skipped, so re-running after a settings change only redoes what it must.
+    processor_settings: Keyword arguments for MidiPostProcessor (genre, tonic, key_type, key_detection_flag, force_to_scale...)
+    force: Reprocess every file, even if its output is up to date
+    """
+    config = {"processor": dict(processor_settings or {}, output_dir=output_dir), "drums": drums, "beat_length": beat_length}
+    config_path, changed = write_config(output_dir, config)
+    if changed:
+        print(f"Settings changed, every output in {output_dir} will be remade")
+
+    inputs = list_inputs(source)
+    tasks = []
+    for input_path, relative_path in inputs:
+        output_path = output_path_for(relative_path, output_dir, drums)
+        if force or not is_up_to_date(input_path, output_path, config_path):
+            tasks.append((input_path, output_path))
+    skipped = len(inputs) - len(tasks)
+
+    run = PoolRun()
+    if tasks:
+        with Pool(num_workers, initializer=_init_worker, initargs=(config,)) as pool:
+            for result in tqdm(pool.imap_unordered(process_file, tasks, chunksize=4), total=len(tasks), desc="Postprocessing MIDI files", unit="file"):
+                run.record(result)
+
+    run.finish()
+    run.report(f"Postprocessed {run.done} files ({skipped} already up to date)")
+    return {"processed": run.done, "skipped": skipped, "failed": sum(run.failures.values())}
+
+if __name__ == "__main__": # Run as python -m POSTPROCESSING.batch_postprocess
+    parser = argparse.ArgumentParser(description="Postprocess a directory (or manifest) of MIDI files across all cores, skipping outputs that are already up to date")
+    parser.add_argument("source", help="Directory of MIDI files, or a text file listing one MIDI path per line")
+    parser.add_argument("output_dir")
+    parser.add_argument("--genre", default="jazz")
+    parser.add_argument("--key", nargs=2, metavar=("TONIC", "KEY_TYPE"), default=None, help="Use this key (e.g. C major) instead of detecting each file's key")
+    parser.add_argument("--key-profile", choices=sorted(KEY_PROFILES), default="aarden_essen")
+    parser.add_argument("--no-force-to-scale", action="store_true")
+    parser.add_argument("--no-glue", action="store_true")
+    parser.add_argument("--monophonic", action="store_true")
+    parser.add_argument("--drums", action="store_true", help="Also add a drum track")
+    parser.add_argument("--beat-length", type=float, default=0.25)
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (defaults to the number of CPUs)")
+    parser.add_argument("--force", action="store_true", help="Reprocess every file, even if its output is up to date")
+    args = parser.parse_args()
+    settings = {
+        "genre": args.genre,
+        "key_detection_flag": args.key is None,
+        "force_to_scale": not args.no_force_to_scale,
+        "glue_notes_flag": not args.no_glue,
+        "make_monophonic": args.monophonic,
+        "key_profile": args.key_profile,
+    }
+    if args.key is not None:
+        settings["tonic"], settings["key_type"] = args.key
+    batch_postprocess(args.source, args.output_dir, settings, args.drums, args.beat_length, args.workers, args.force)
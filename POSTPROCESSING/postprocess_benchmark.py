@@ -0,0 +1,164 @@
+import argparse
+import io
+import time
+from contextlib import redirect_stdout
+from glob import glob
+import numpy as np
+import pretty_midi
+from music21 import converter, key
+from SHARED import flatten_notes, glue_notes
+from .postprocess_midi import MidiPostProcessor
+
+def benchmark_key_detection(midi_paths, repeats = 3):
+    """
+    Key detection with a music21 parse + analyze("key") (the old way) against the built-in pitch-class histogram detector, on the same files.
+    The detector is timed on the PrettyMIDI the postprocessor has already loaded. Reports the time per file of each and whether they agree
+    """
+    processor = MidiPostProcessor()
+    results = []
+    for path in midi_paths:
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            music21_key = converter.parse(path).analyze("key")
+        music21_seconds = (time.perf_counter() - start_time) / repeats
+
+        midi = processor.load_midi(path)
+        with redirect_stdout(io.StringIO()): # _detect_key prints every key it finds
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                native_key = processor._detect_key(midi)
+            native_seconds = (time.perf_counter() - start_time) / repeats
+
+        expected = (music21_key.tonic.name, music21_key.mode)
+        results.append({"path": path, "music21": expected, "native": native_key, "music21_seconds": music21_seconds, "native_seconds": native_seconds})
+
+    print(f"{'file':<28}{'music21':>14}{'native':>14}{'music21 ms':>12}{'native ms':>11}{'speedup':>9}")
+    for result in results:
+        name = result["path"].replace("\\", "/").split("/")[-1]
+        print(f"{name:<28}{' '.join(result['music21']):>14}{' '.join(result['native']):>14}{result['music21_seconds'] * 1000:>12.1f}"
+              f"{result['native_seconds'] * 1000:>11.2f}{result['music21_seconds'] / result['native_seconds']:>8.0f}x" + ("" if result["music21"] == result["native"] else "  MISMATCH"))
+    matches = sum(result["music21"] == result["native"] for result in results)
+    print(f"{matches}/{len(results)} keys match music21")
+    return results
+
+def _per_note_transform(processor, notes, scale_pitches):
+    """The postprocessor's old note loop: quantize, minimum length and scale snapping one pretty_midi note at a time"""
+    for note in notes:
+        if processor.genre in ["jazz"]:
+            note.start = processor._swing_quantize_time(note.start, grid=0.25, swing_amount=0.1)
+            note.end = processor._swing_quantize_time(note.end, grid=0.25, swing_amount=0.1)
+        else:
+            note.start = processor._quantize_time(note.start, grid=0.25)
+            note.end = processor._quantize_time(note.end, grid=0.25)
+        if note.end <= note.start:
+            note.end = note.start + 0.25
+        note.pitch = processor._force_to_scale(note.pitch, scale_pitches)
+
+def _random_notes(num_notes, seed = 0):
+    """Dense random notes, with some starts and ends exactly halfway between grid steps to exercise the rounding"""
+    rng = np.random.default_rng(seed)
+    starts = rng.uniform(0, num_notes / 8, num_notes)
+    starts[::7] = np.round(starts[::7] * 8) / 8 # Halfway between 1/16 steps
+    ends = starts + rng.choice([0.05, 0.1, 0.125, 0.3, 1.0], num_notes)
+    pitches = rng.integers(0, 128, num_notes)
+    velocities = rng.integers(1, 128, num_notes)
+    return [pretty_midi.Note(velocity=int(v), pitch=int(p), start=float(s), end=float(e)) for s, e, p, v in zip(starts, ends, pitches, velocities)]
+
+def benchmark_note_transforms(num_notes = 20000, genres = ("jazz", "pop"), tonic = "E-", key_type = "major"):
+    """Notes/sec of the old per-note quantize + scale snapping loop against the structured-array version, checking both give the same notes"""
+    processor = MidiPostProcessor(tonic=tonic, key_type=key_type, key_detection_flag=False)
+    scale_pitches = [p for p in key.Key(tonic, key_type).pitches]
+    results = {}
+    for genre in genres:
+        processor.genre = genre
+        per_note, vectorized = _random_notes(num_notes), _random_notes(num_notes)
+
+        start_time = time.perf_counter()
+        _per_note_transform(processor, per_note, scale_pitches)
+        per_note_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        scale_table = processor._scale_table(tonic, key_type) # Built once per key, so it is timed on the first genre only
+        processor._write_notes(vectorized, processor._transform_notes(processor._notes_to_array(vectorized), scale_table))
+        vectorized_seconds = time.perf_counter() - start_time
+
+        identical = all((a.start, a.end, a.pitch, a.velocity) == (b.start, b.end, b.pitch, b.velocity) for a, b in zip(per_note, vectorized))
+        results[genre] = {"per_note_seconds": per_note_seconds, "vectorized_seconds": vectorized_seconds, "identical": identical}
+        print(f"{genre:<6} {num_notes} notes: per note {num_notes / per_note_seconds:>10.0f} notes/sec, arrays {num_notes / vectorized_seconds:>10.0f} notes/sec "
+              f"(x{per_note_seconds / vectorized_seconds:.0f}), {'identical' if identical else 'DIFFERENT'} notes")
+    return results
+
+def _synthetic_track(num_notes, seed = 0):
+    """A dense track on a 1/16 grid: chords, repeated pitches and overlaps, so both sweeps have work to do"""
+    rng = np.random.default_rng(seed)
+    starts = np.round(rng.uniform(0, num_notes / 16, num_notes) * 4) / 4
+    ends = starts + rng.choice([0.2, 0.25, 0.5, 1.0], num_notes)
+    pitches = rng.integers(60, 72, num_notes)
+    velocities = rng.integers(40, 128, num_notes)
+    return [pretty_midi.Note(velocity=int(v), pitch=int(p), start=float(s), end=float(e)) for s, e, p, v in zip(starts, ends, pitches, velocities)]
+
+def _previous_glue_notes(notes, threshold = 0.1):
+    """The glue loop the postprocessor had before note_sweeps.py, only to count the note objects it repeated"""
+    notes = sorted(notes, key=lambda note: note.start)
+    glued_notes = []
+    previous_note = None
+    for note in notes:
+        if previous_note and (note.start - previous_note.end) <= threshold:
+            if note.pitch == previous_note.pitch:
+                previous_note.end = max(previous_note.end, note.end)
+                glued_notes.append(previous_note)
+            else:
+                glued_notes.append(note)
+        elif not previous_note:
+            previous_note = notes[0]
+            glued_notes.append(previous_note)
+        else:
+            glued_notes.append(note)
+    return glued_notes
+
+def _check_glued(notes, threshold):
+    """Every note at most once, and no two kept notes of a pitch close enough to have been glued"""
+    if len({id(note) for note in notes}) != len(notes):
+        return False
+    last_end = {}
+    for note in notes:
+        if note.pitch in last_end and note.start - last_end[note.pitch] <= threshold:
+            return False
+        last_end[note.pitch] = note.end
+    return True
+
+def _check_flattened(notes):
+    """Every note at most once, in start order, each ending before the next one starts"""
+    return len({id(note) for note in notes}) == len(notes) and all(a.start < b.start and a.end <= b.start for a, b in zip(notes, notes[1:]))
+
+def benchmark_note_sweeps(sizes = (10000, 100000, 1000000), threshold = 0.1):
+    """Time per note of the shared glue and flatten sweeps on synthetic tracks (flat as the track grows, being O(n log n)), checking each result"""
+    results = {}
+    for num_notes in sizes:
+        result = {}
+        for name, sweep, check in (
+            ("glue", lambda notes: glue_notes(notes, threshold), lambda notes: _check_glued(notes, threshold)),
+            ("flatten", lambda notes: flatten_notes(notes, velocity_ratio=0.8), _check_flattened),
+        ):
+            notes = _synthetic_track(num_notes)
+            start_time = time.perf_counter()
+            kept = sweep(notes)
+            result[name] = {"seconds": time.perf_counter() - start_time, "kept": len(kept), "valid": check(kept)}
+        previous = _previous_glue_notes(_synthetic_track(num_notes), threshold)
+        result["previous_glue_repeats"] = len(previous) - len({id(note) for note in previous})
+        results[num_notes] = result
+        print(f"{num_notes:>8} notes: glue {result['glue']['seconds'] / num_notes * 1e6:.2f} us/note ({result['glue']['kept']} kept, {'valid' if result['glue']['valid'] else 'INVALID'}), "
+              f"flatten {result['flatten']['seconds'] / num_notes * 1e6:.2f} us/note ({result['flatten']['kept']} kept, {'valid' if result['flatten']['valid'] else 'INVALID'}), "
+              f"previous glue repeated {result['previous_glue_repeats']} notes")
+    return results
+
+if __name__ == "__main__": # Run as python -m POSTPROCESSING.postprocess_benchmark
+    parser = argparse.ArgumentParser(description="Benchmark postprocessing against the previous implementation")
+    parser.add_argument("midi_dir", nargs="?", default="Demo_generated_songs")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--notes", type=int, default=20000, help="Number of synthetic notes for the note transform benchmark")
+    parser.add_argument("--sweep-sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="Track sizes for the glue and flatten benchmark")
+    args = parser.parse_args()
+    benchmark_key_detection(sorted(glob(f"{args.midi_dir}/**/*.mid", recursive=True)), args.repeats)
+    benchmark_note_transforms(args.notes)
+    benchmark_note_sweeps(args.sweep_sizes)
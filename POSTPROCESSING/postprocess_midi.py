@@ -1,10 +1,40 @@
 import pretty_midi
-from music21 import key, note, pitch, converter
+from music21 import key, note, pitch
+import io
 import os
 from pathlib import Path
+import numpy as np
+from SHARED import flatten_notes, glue_notes
+
+# Tonic spellings music21's key analysis gives each pitch class (C = 0), e.g. A- major but G# minor
+MAJOR_TONICS = ["C", "C#", "D", "E-", "E", "F", "F#", "G", "A-", "A", "B-", "B"]
+MINOR_TONICS = ["C", "C#", "D", "E-", "E", "F", "F#", "G", "G#", "A", "B-", "B"]
+
+# (major, minor) weight of each scale degree above the tonic. Aarden-Essen is what music21's analyze("key") uses
+KEY_PROFILES = {
+    "aarden_essen": (
+        [17.7661, 0.145624, 14.9265, 0.160186, 19.8049, 11.3587, 0.291248, 22.062, 0.145624, 8.15494, 0.232998, 4.95122],
+        [18.2648, 0.737619, 14.0499, 16.8599, 0.702494, 14.4362, 0.702494, 18.6161, 4.56621, 1.93186, 7.37619, 1.75623],
+    ),
+    "krumhansl_kessler": (
+        [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88],
+        [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17],
+    ),
+}
+KEY_NAMES = [(tonic, "major") for tonic in MAJOR_TONICS] + [(tonic, "minor") for tonic in MINOR_TONICS] # Row order of the key matrix
+
+def _key_matrix(profile):
+    """The 24 key profiles (12 majors then 12 minors) as rows, each rotated to start on its tonic and centred, ready for a correlation by matrix multiply"""
+    rows = np.array([np.roll(weights, tonic) for weights in KEY_PROFILES[profile] for tonic in range(12)])
+    rows -= rows.mean(axis=1, keepdims=True)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+_KEY_MATRICES = {profile: _key_matrix(profile) for profile in KEY_PROFILES}
+
+NOTE_DTYPE = np.dtype([("start", np.float64), ("end", np.float64), ("pitch", np.int64), ("velocity", np.int64)]) # One row per note, for transforming a whole instrument at once
 
 class MidiPostProcessor:
-    def __init__(self, genre="jazz", tonic="C", key_type="major", key_detection_flag=True, force_to_scale = True, glue_notes_flag=True, make_monophonic = False ,output_dir=r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\files\generated_midi_files\postprocessed"):
+    def __init__(self, genre="jazz", tonic="C", key_type="major", key_detection_flag=True, force_to_scale = True, glue_notes_flag=True, make_monophonic = False, output_dir=r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\files\generated_midi_files\postprocessed", key_profile = "aarden_essen"):
         self.OUTPUT_DIR = output_dir
         
         self.genre = genre.lower() # Make sure that any capital letters won't affect the code working properly
@@ -14,16 +44,17 @@ class MidiPostProcessor:
         self.force_to_scale = force_to_scale
         self.glue_notes_flag = glue_notes_flag
         self.make_monophonic = make_monophonic
+        self.key_profile = key_profile
 
     # Quantize to nearest grid step
     def _quantize_time(self, time, grid = 0.25):
-        """Snap time to nearest grid (e.g., 0.25 = 1/16 note if 1.0=quarter note)."""
-        return round(time / grid) * grid
+        """Snap time (a number or an array) to nearest grid (e.g., 0.25 = 1/16 note if 1.0=quarter note). Halfway values round to even, like round()"""
+        return np.round(time / grid) * grid
 
     # Force pitch into scale of choice
     def _force_to_scale(self, midi_note, scale_pitches):
         """Shift a MIDI note to the nearest pitch in the chosen scale."""
-        p = pitch.Pitch(midi_note)
+        p = pitch.Pitch(midi=midi_note) # midi= so that notes below 12 are not read as pitch classes without an octave
 
         # Find note's octave
         octave = p.octave
@@ -36,32 +67,24 @@ class MidiPostProcessor:
         
         return closest.midi
 
+    _scale_tables = {} # (tonic, key type) -> lookup table, shared by every postprocessor
+
+    def _scale_table(self, tonic, key_type):
+        """Lookup table of the pitch _force_to_scale gives each of the 128 MIDI notes in a key, so a whole array of pitches is snapped by indexing"""
+        if (tonic, key_type) not in self._scale_tables:
+            scale_pitches = [p for p in key.Key(tonic, key_type).pitches]
+            self._scale_tables[(tonic, key_type)] = np.array([self._force_to_scale(midi_note, scale_pitches) for midi_note in range(128)], dtype=np.int64)
+        return self._scale_tables[(tonic, key_type)]
+
     def _swing_quantize_time(self, time, grid = 0.25, swing_amount = 0.1):
         """Add swing quantization to make midi sound more human, for selected genres"""
         quantized_time = self._quantize_time(time, grid)
-        if quantized_time % 1 == 0:  # If on beat
-            return quantized_time + swing_amount
-        return quantized_time
+        return quantized_time + np.where(quantized_time % 1 == 0, swing_amount, 0.0)  # Only notes on the beat are pushed back
 
     def _glue_notes(self, midi, threshold = 0.1):
         """Glue notes that are very close together to make the final audio sound more conjoined"""
         for instrument in midi.instruments:
-            instrument.notes.sort(key = lambda note: note.start)  # Ensure notes are sorted by start time
-            glued_notes = []
-            previous_note = None
-            for note in instrument.notes:
-                if previous_note and (note.start - previous_note.end) <= threshold: # If the second current start within the threshold of the previous note
-                    if note.pitch == previous_note.pitch: # Only glue if they are the same pitch
-                        previous_note.end = max(previous_note.end, note.end)
-                        glued_notes.append(previous_note)
-                    else:
-                        glued_notes.append(note)
-                elif not previous_note:
-                    previous_note = instrument.notes[0]
-                    glued_notes.append(previous_note)
-                else:
-                    glued_notes.append(note)
-            instrument.notes = glued_notes
+            instrument.notes = glue_notes(instrument.notes, threshold) # Each note joins the last note of the same pitch if it starts within the threshold of its end
 
     def _remove_leading_silence(self, midi):
         """Shift all notes so the first note starts at tick 0"""
@@ -79,44 +102,126 @@ class MidiPostProcessor:
         """Make the melody monophonic by removing overlapping notes. Higher pitch notes are prioritised."""
         # This is so that there are no chords, only a melody
         for track in midi.instruments:
-            if not track.notes:
-                continue
-            # Sort notes by start time, and then by pitch (descending so it uses the higher note first) for notes starting at the same time
-            notes = sorted(track.notes, key=lambda n: (n.start, -n.pitch))
-            flattened_notes = [] # List to hold the flattened notes
-            active_note = None
-
-            # Iterate through sorted notes and add to flattened list if they don't overlap
-            for note in notes:
-                if active_note is None:
-                    # Start with the first note
-                    active_note = note
-                    flattened_notes.append(active_note)
-                else:
-                    if note.start == active_note.start:
-                        # If multiple notes start at the same time, keep the higher pitch note to remove chords
-                        continue
-                    # If the the new note's velocity is too low, even if it is a higher pitch, skip it
-                    if note.velocity < active_note.velocity * 0.8:
-                        continue
-                    elif note.start < active_note.end:
-                        # If new note is higher pitch and overlaps, cut the active note short
-                        if note.pitch > active_note.pitch:
-                            active_note.end = note.start
-                            active_note = note
-                            flattened_notes.append(active_note)
-                        #Otherwise, skip the overlapping note
-                    else:
-                        flattened_notes.append(note) # Add note if it doesn't overlap
-                        active_note = note
-            track.notes = flattened_notes # Replace the track's notes with the flattened melody
+            if track.notes:
+                track.notes = flatten_notes(track.notes, velocity_ratio=0.8) # Notes much quieter than the current one are skipped, even if they are higher
         return midi
 
-    def _detect_key(self, midi_file_path):
-        score = converter.parse(midi_file_path)
-        detected_key = score.analyze("key")  # Use music21 to automatically detect/predict the key of the midi file
-        print(f"Detected key: {detected_key.tonic.name} {detected_key.mode}")
-        return detected_key.tonic.name, detected_key.mode
+    @staticmethod
+    def _notes_to_array(notes):
+        """Structured array (NOTE_DTYPE) of a list of pretty_midi notes"""
+        return np.fromiter(((note.start, note.end, note.pitch, note.velocity) for note in notes), dtype=NOTE_DTYPE, count=len(notes))
+
+    @staticmethod
+    def _write_notes(notes, array):
+        """Copy a structured note array back into the pretty_midi notes it was made from, as plain Python numbers"""
+        for note, start, end, note_pitch, velocity in zip(notes, array["start"].tolist(), array["end"].tolist(), array["pitch"].tolist(), array["velocity"].tolist()):
+            note.start, note.end, note.pitch, note.velocity = start, end, note_pitch, velocity
+
+    def _transform_notes(self, notes, scale_table = None):
+        """Quantize (with swing for swung genres), give every note a minimum length and snap pitches to the scale, for a whole structured note array at once"""
+        notes = notes.copy()
+        if self.genre in ["jazz"]:
+            notes["start"] = self._swing_quantize_time(notes["start"], grid=0.25, swing_amount=0.1)
+            notes["end"] = self._swing_quantize_time(notes["end"], grid=0.25, swing_amount=0.1)
+        else:
+            notes["start"] = self._quantize_time(notes["start"], grid=0.25)  # 1/16 note grid
+            notes["end"] = self._quantize_time(notes["end"], grid=0.25)
+        too_short = notes["end"] <= notes["start"]  # Avoid zero-length notes
+        notes["end"][too_short] = notes["start"][too_short] + 0.25
+        if scale_table is not None:
+            notes["pitch"] = scale_table[notes["pitch"]]
+        return notes
+
+    def _note_arrays(self, midi):
+        """Pitch classes and start/end positions in quarter notes of every pitched note, as arrays (drums are skipped)"""
+        notes = [(note.pitch, note.start, note.end) for instrument in midi.instruments if not instrument.is_drum for note in instrument.notes]
+        if not notes:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+        pitches, starts, ends = np.array(notes).T
+        return pitches.astype(np.int64) % 12, self._seconds_to_quarters(midi, starts), self._seconds_to_quarters(midi, ends)
+
+    @staticmethod
+    def _tempo_map(midi):
+        """Time (seconds) and tick at which each tempo starts, and its seconds per tick, from get_tempo_changes (the public view of the tempo map)"""
+        change_times, tempi = midi.get_tempo_changes()
+        change_ticks = np.array([midi.time_to_tick(change_time) for change_time in change_times], dtype=np.float64)
+        return change_times, change_ticks, 60.0 / (tempi * midi.resolution)
+
+    @classmethod
+    def _seconds_to_quarters(cls, midi, times):
+        """Positions in quarter notes of times in seconds: time_to_tick / resolution for a whole array at once"""
+        change_times, change_ticks, seconds_per_tick = cls._tempo_map(midi)
+        segment = np.maximum(np.searchsorted(change_times, times, side="right") - 1, 0)
+        ticks = np.round(change_ticks[segment] + (times - change_times[segment]) / seconds_per_tick[segment])
+        return ticks / midi.resolution
+
+    @classmethod
+    def _quarters_to_seconds(cls, midi, quarters):
+        """Times in seconds of positions in quarter notes, the inverse of _seconds_to_quarters (unlike tick_to_time, also past the ticks the file was loaded with)"""
+        change_times, change_ticks, seconds_per_tick = cls._tempo_map(midi)
+        ticks = np.round(np.asarray(quarters) * midi.resolution)
+        segment = np.maximum(np.searchsorted(change_ticks, ticks, side="right") - 1, 0)
+        return change_times[segment] + (ticks - change_ticks[segment]) * seconds_per_tick[segment]
+
+    @staticmethod
+    def _sounded_time(starts, ends, times):
+        """
+        Total time the notes have sounded up to each of times, i.e. the sum of clip(time - start, 0, end - start) over the notes, in O((notes + times) log notes)
+        memory and time: every note that has started counts time - start, minus time - end for every note that has also ended
+        """
+        starts, ends = np.sort(starts), np.sort(ends)
+        start_sums = np.concatenate([[0.0], np.cumsum(starts)])
+        end_sums = np.concatenate([[0.0], np.cumsum(ends)])
+        started = np.searchsorted(starts, times, side="right")
+        ended = np.searchsorted(ends, times, side="right")
+        return (started * times - start_sums[started]) - (ended * times - end_sums[ended])
+
+    def _best_keys(self, histograms):
+        """Key (tonic, mode) whose profile correlates best with each histogram row: all 24 correlations of every row in one matrix multiply"""
+        centred = histograms - histograms.mean(axis=1, keepdims=True)
+        norms = np.linalg.norm(centred, axis=1, keepdims=True)
+        correlations = (centred / np.where(norms > 0, norms, 1)) @ _KEY_MATRICES[self.key_profile].T # [rows, 24] Pearson correlations
+        return [KEY_NAMES[index] for index in correlations.argmax(axis=1)]
+
+    def _detect_key(self, midi):
+        """
+        Detect the key of a PrettyMIDI without converting it for music21: the same analysis as music21's analyze("key") (with the default profile),
+        which picks the key whose profile correlates best with the duration-weighted pitch-class histogram
+        """
+        pitch_classes, starts, ends = self._note_arrays(midi)
+        histogram = np.bincount(pitch_classes, weights=ends - starts, minlength=12) # Total length of each pitch class in quarter notes
+        if not histogram.any():
+            print(f"No notes to detect the key from, keeping {self.tonic} {self.key_type}")
+            return self.tonic, self.key_type
+        tonic, mode = self._best_keys(histogram[None, :])[0]
+        print(f"Detected key: {tonic} {mode}")
+        return tonic, mode
+
+    def detect_key_changes(self, midi, window_beats = 16, hop_beats = 8):
+        """
+        Key of each stretch of a piece, from the notes sounding in windows of window_beats quarter notes every hop_beats.
+        Returns [(start time in seconds, tonic, mode)], one entry each time the key changes. Windows with no notes keep the previous key
+        """
+        midi = self.load_midi(midi)
+        pitch_classes, starts, ends = self._note_arrays(midi)
+        if len(pitch_classes) == 0:
+            return []
+        window_starts = np.arange(0, max(ends.max() - window_beats, 0) + hop_beats, hop_beats)
+        window_bounds = np.stack([window_starts, window_starts + window_beats])
+        # How long each pitch class sounds inside each window: the time it has sounded by the window's end minus by its start
+        histograms = np.zeros((len(window_starts), 12))
+        for pitch_class in range(12):
+            in_class = pitch_classes == pitch_class
+            sounded = self._sounded_time(starts[in_class], ends[in_class], window_bounds)
+            histograms[:, pitch_class] = sounded[1] - sounded[0]
+        histograms[histograms < 1e-9] = 0 # Rounding left over from the cumulative sums in windows where the pitch class is silent
+
+        changes = []
+        sounding = histograms.any(axis=1)
+        for start_time, (tonic, mode) in zip(self._quarters_to_seconds(midi, window_starts[sounding]).tolist(), self._best_keys(histograms[sounding])):
+            if not changes or changes[-1][1:] != (tonic, mode):
+                changes.append((start_time, tonic, mode))
+        return changes
     
     def set_key_manually(self, tonic, key_type):
         self.key_detection = False
@@ -138,50 +243,63 @@ class MidiPostProcessor:
     def set_force_to_scale(self, force_to_scale = True):
         self.force_to_scale = force_to_scale
 
+    @staticmethod
+    def load_midi(midi):
+        """PrettyMIDI from a file path, the bytes of a MIDI file, or a PrettyMIDI (returned as is, so it gets modified in place)"""
+        if isinstance(midi, pretty_midi.PrettyMIDI):
+            return midi
+        if isinstance(midi, (bytes, bytearray)):
+            return pretty_midi.PrettyMIDI(io.BytesIO(midi))
+        return pretty_midi.PrettyMIDI(midi)
+
+    @staticmethod
+    def to_bytes(midi):
+        """The bytes of a PrettyMIDI as a MIDI file, without writing it to disk"""
+        buffer = io.BytesIO()
+        midi.write(buffer)
+        return buffer.getvalue()
+
+    def save(self, midi, file_name):
+        """Write a PrettyMIDI into the output directory"""
+        os.makedirs(self.OUTPUT_DIR, exist_ok=True)
+        output_path = os.path.join(self.OUTPUT_DIR, file_name)
+        midi.write(output_path)
+        return output_path
+
     # Use a postprocessing function to make the output more consistent
-    def postprocess_midi(self, midi_file_path):
-        """Postprocess a MIDI file by applying various transformations e.g. quantization, tuning to the correct key, gluing notes and making midi files monophonic"""
-        midi = pretty_midi.PrettyMIDI(midi_file_path)
+    def process(self, midi):
+        """
+        Postprocess MIDI in memory by applying various transformations e.g. quantization, tuning to the correct key, gluing notes and making midi files monophonic.
+        midi: A file path, MIDI file bytes or a PrettyMIDI. Returns the processed PrettyMIDI, so stages can be chained without touching the disk
+        """
+        midi = self.load_midi(midi)
         if self.key_detection:
-            self.tonic, self.key_type = self._detect_key(midi_file_path) # Detect key if chosen, otherwise use given key in parameters
-        key_used = key.Key(self.tonic, self.key_type)
-        scale_pitches = [p for p in key_used.pitches]  # All the notes used in the scale of choice
+            self.tonic, self.key_type = self._detect_key(midi) # Detect key if chosen, otherwise use given key in parameters
+        scale_table = self._scale_table(self.tonic, self.key_type) if self.force_to_scale else None  # Where each pitch lands in the scale of choice
 
-        # Process each instrument
+        # Process each instrument as one array of notes
         for instrument in midi.instruments:
-            for note in instrument.notes:
-                # Quantize start & end
-                if self.genre in ["jazz"]:
-                    note.start = self._swing_quantize_time(note.start, grid=0.25, swing_amount=0.1)
-                    note.end = self._swing_quantize_time(note.end, grid=0.25, swing_amount=0.1)
-                else:
-                    note.start = self._quantize_time(note.start, grid=0.25)  # 1/16 note grid
-                    note.end = self._quantize_time(note.end, grid=0.25)
-                if note.end <= note.start:  # Avoid zero-length notes
-                    note.end = note.start + 0.25
-
-                # Force pitch into scale
-                if self.force_to_scale:
-                    note.pitch = self._force_to_scale(note.pitch, scale_pitches)
+            if instrument.notes:
+                self._write_notes(instrument.notes, self._transform_notes(self._notes_to_array(instrument.notes), scale_table))
         if self.glue_notes_flag:
             self._glue_notes(midi)
         self._remove_leading_silence(midi)
         if self.make_monophonic:
             self._flatten_melody(midi)
+        return midi
+
+    def postprocess_midi(self, midi_file_path):
+        """Postprocess a MIDI file and save the result in the output directory, returning its path"""
+        midi = self.process(midi_file_path)
 
         # Save cleaned MIDI
-        midi_output_dir = self.OUTPUT_DIR
-        os.makedirs(midi_output_dir, exist_ok=True)
-        
-        midi_file_path = Path(midi_file_path)
-        midi_output_path = os.path.join(midi_output_dir, f"{midi_file_path.stem}_postprocessed.mid")
-        midi.write(midi_output_path)
-        
+        midi_output_path = self.save(midi, f"{Path(midi_file_path).stem}_postprocessed.mid")
         print(f"Postprocessed MIDI saved as {midi_output_path}")
         return midi_output_path
-    
-    def add_drums(self, midi_file_path, beat_length = 0.25):
-        midi = pretty_midi.PrettyMIDI(midi_file_path)
+
+    def add_drum_track(self, midi, beat_length = 0.25):
+        """Add a drum track to a PrettyMIDI (or a path / MIDI bytes) in memory, returning the PrettyMIDI"""
+        midi = self.load_midi(midi)
         # Create a new drum instrument
         drum = pretty_midi.Instrument(program=0, is_drum=True)
 
@@ -204,8 +322,10 @@ class MidiPostProcessor:
             t += beat_length
             beat_count += 0.5
         midi.instruments.append(drum)
+        return midi
 
-        output_file_path = os.path.join(self.OUTPUT_DIR, f"{Path(midi_file_path).stem}_with_drums.mid")
+    def add_drums(self, midi_file_path, beat_length = 0.25):
+        """Add a drum track to a MIDI file and save the result in the output directory, returning its path"""
+        midi = self.add_drum_track(midi_file_path, beat_length)
         # Save the modified MIDI file
-        midi.write(output_file_path)
-        return output_file_path
\ No newline at end of file
+        return self.save(midi, f"{Path(midi_file_path).stem}_with_drums.mid")
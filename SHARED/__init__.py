@@ -0,0 +1,2 @@
+from .note_sweeps import flatten_notes, glue_notes
+from .pool_run import PoolRun
\ No newline at end of file
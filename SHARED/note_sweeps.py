@@ -0,0 +1,44 @@
+# Sort-once sweeps over a track's notes, shared by the extraction scripts (miditoolkit notes, in ticks) and the postprocessor (pretty_midi notes, in seconds): O(n log n) per track.
+
+def flatten_notes(notes, velocity_ratio = None):
+    """
+    Make a track monophonic by removing overlapping notes, prioritising higher pitches. Returns the kept notes in start order.
+    Notes starting together keep only the highest. A higher note starting while another sounds cuts the sounding note short; a lower one is dropped.
+    velocity_ratio: Also drop any note quieter than this fraction of the last kept note's velocity (None keeps every velocity)
+    """
+    # Sort notes by start time, and then by pitch (descending so the higher note comes first) for notes starting at the same time
+    flattened_notes = []
+    active_note = None
+    for note in sorted(notes, key=lambda n: (n.start, -n.pitch)):
+        if active_note is None:
+            active_note = note
+            flattened_notes.append(note)
+        elif note.start == active_note.start: # A lower note of a chord
+            continue
+        elif velocity_ratio is not None and note.velocity < active_note.velocity * velocity_ratio:
+            continue
+        elif note.start < active_note.end:
+            if note.pitch > active_note.pitch: # Cut the active note short for the higher note
+                active_note.end = note.start
+                active_note = note
+                flattened_notes.append(note)
+        else:
+            flattened_notes.append(note)
+            active_note = note
+    return flattened_notes
+
+def glue_notes(notes, threshold):
+    """
+    Merge each note into the last kept note of the same pitch when it starts within threshold of that note's end (or overlaps it), extending the kept note.
+    Returns the kept notes in start order, each once. Notes of other pitches in between don't stop two notes being glued
+    """
+    glued_notes = []
+    last_by_pitch = {} # Pitch -> last kept note of that pitch
+    for note in sorted(notes, key=lambda n: n.start):
+        previous_note = last_by_pitch.get(note.pitch)
+        if previous_note is not None and note.start - previous_note.end <= threshold:
+            previous_note.end = max(previous_note.end, note.end)
+        else:
+            glued_notes.append(note)
+            last_by_pitch[note.pitch] = note
+    return glued_notes
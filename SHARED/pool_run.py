@@ -0,0 +1,37 @@
+# Bookkeeping shared by the scripts that fan files out over a multiprocessing Pool (tokenize_dataset, extract_tracks, dedup_corpus, batch_postprocess).
+# Those scripts only start their run under if __name__ == "__main__": worker processes import the script, and must not start another run when they do.
+import time
+from pathlib import Path
+from collections import Counter
+
+class PoolRun:
+    """Counts the files a pool run finished and the ones that failed, and reports files/sec and failures by error type at the end"""
+    def __init__(self):
+        self.done = 0
+        self.failures = Counter()
+        self.start_time = time.perf_counter()
+        self.seconds = 0.0
+
+    def record(self, result):
+        """Count one worker result, a dict with the file's "path" (and "error" and "message" if it failed). Failures are printed, returns whether the file succeeded"""
+        if "error" in result:
+            self.failures[result["error"]] += 1
+            print(f"Skipping {Path(result['path']).name} due to error: {result['message']}")
+            return False
+        self.done += 1
+        return True
+
+    def finish(self):
+        """Stop the clock, returning how many seconds the run took"""
+        self.seconds = time.perf_counter() - self.start_time
+        return self.seconds
+
+    def rate(self, count):
+        """count per second of the finished run"""
+        return count / self.seconds if self.seconds > 0 else 0.0
+
+    def report(self, summary, extra = ""):
+        """Print "<summary> in <seconds>s (<files/s><extra>)" and the failures by error type"""
+        print(f"{summary} in {self.seconds:.1f}s ({self.rate(self.done):.1f} files/s{extra})")
+        if self.failures:
+            print("Failures by error type: " + ", ".join(f"{error}: {count}" for error, count in self.failures.most_common()))
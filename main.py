@@ -6,6 +6,7 @@
 # 5. Render the generated midi into a wav file
 
 import os
+from pathlib import Path
 from AUDIO_TO_MIDI_CONVERTER import audio_to_midi
 from POSTPROCESSING import MidiPostProcessor
 from AI_MODELS import AIGenerator
@@ -65,10 +66,11 @@ merged_midi_path = tokenizer.merge_midi_paths()
 
 # Postprocess the merged midi file
 midi_post_processor = MidiPostProcessor(genre = genre, glue_notes_flag=False, make_monophonic=False, force_to_scale=True)
-postprocessed_midi_path = midi_post_processor.postprocess_midi(merged_midi_path)
+postprocessed_midi = midi_post_processor.process(merged_midi_path) # Kept in memory so adding drums doesn't read it back from disk
 
-# Add drums to the postprocessed midi file
-postprocessed_midi_path = midi_post_processor.add_drums(postprocessed_midi_path)
+# Add drums to the postprocessed midi and save it
+midi_post_processor.add_drum_track(postprocessed_midi)
+postprocessed_midi_path = midi_post_processor.save(postprocessed_midi, f"{Path(merged_midi_path).stem}_postprocessed_with_drums.mid")
 
 # Render the postprocessed midi file into a wav file
 renderer = MidiRenderer(soundfont = r"C:\Users\rober\OneDrive\Documents\0.School\WILLIAM PERKIN\Comp\1. NEA project prototype\soundfonts\Arachno_SoundFont_Version_1.0.sf2")